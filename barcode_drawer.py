@@ -1,7 +1,33 @@
-from PIL import Image, ImageDraw
+from PIL import Image, ImageFilter
+from functools import lru_cache, partial
+import numpy as np
 import colorsys
-import random
+import io
 import math
+import os
+
+from instrument import stage
+
+# next to this module, so the tools work from any directory
+DEFAULT_LOGO_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'logo.jpg')
+# number of (logo, height, bar width) combinations kept prepared in memory
+LOGO_CACHE_SIZE = 32
+# a stacked symbol splits its codeword over up to this many rows, the header bar after the logo holds the count
+MAX_STACK_ROWS = 32
+# hue range the row indicator bytes are spread over, away from the red that 0xff shares with 0x00
+ROW_INDICATOR_SPAN = 240
+# bytes between the header codes of neighbouring row counts
+ROW_COUNT_STEP = ROW_INDICATOR_SPAN // (MAX_STACK_ROWS - 2)
+
+def hue_to_rgb(byte):
+    # color of a data byte, same float path as the original per-bar drawing
+    hue = (byte / 255.0) * 360
+    return tuple(int(c * 255) for c in colorsys.hsv_to_rgb(hue / 360.0, 1.0, 1.0))
+
+# byte to rgb tables, the ecc bar is always hued while data bytes 0 and 255 are white
+HUE_PALETTE = np.array([hue_to_rgb(byte) for byte in range(256)], dtype=np.uint8)
+DATA_PALETTE = HUE_PALETTE.copy()
+DATA_PALETTE[[0, 255]] = 255
 
 def set_finder_pattern(array, error_correction_level=0):
     array[0] = 0
@@ -9,54 +35,102 @@ def set_finder_pattern(array, error_correction_level=0):
     array[2] = 0
     array[-1] = 0
 
-def get_array_image(array, barWidth, img_height):
-    arrayCpy = array.copy()
+def row_indicator(row, rows):
+    # byte of the indicator bar that opens each row of a stacked symbol, neighbouring rows far apart in hue
+    return 8 + row * (ROW_INDICATOR_SPAN // rows)
+
+def row_count_code(rows):
+    # byte of the header bar of a stacked symbol, the row counts are as far apart in hue as the span allows
+    # so a noisy header is not read as the next count
+    return 8 + (rows - 2) * ROW_COUNT_STEP
+
+def stack_codeword(codeword, rows):
+    # the codeword bytes row after row in a (rows, columns) grid, the end of the last row padded with 0x00;
+    # a single pad byte would read as one more codeword byte, so the grid gets a column more instead
+    columns = -(-len(codeword) // rows)
+    if rows * columns - len(codeword) == 1:
+        columns += 1
+    grid = np.zeros(rows * columns, dtype=np.uint8)
+    grid[:len(codeword)] = np.frombuffer(bytes(codeword), dtype=np.uint8)
+    return grid.reshape(rows, columns)
 
-    logo = Image.open('logo.jpg')
-    # compute scaling factor to match barcode height
-    w0, h0 = logo.size
-    scale = img_height / min(w0, h0)
-    #print logo size
-    # resize while preserving aspect ratio
-    logo = logo.resize((int(w0 * scale), int(h0 * scale)), Image.Resampling.LANCZOS)
+@lru_cache(maxsize=LOGO_CACHE_SIZE)
+def get_symbol_prefix(logo_path, logo_mtime, img_height, barWidth):
+    # logo_mtime is only part of the cache key, so an edited logo gets prepared again
+    with Image.open(logo_path) as logo:
+        # compute scaling factor to match barcode height
+        w0, h0 = logo.size
+        scale = img_height / min(w0, h0)
+        # resize while preserving aspect ratio
+        logo = logo.resize((int(w0 * scale), int(h0 * scale)), Image.Resampling.LANCZOS)
     # crop to square centered on resized logo
     lw, lh = logo.size
     left = (lw - img_height) // 2
     top  = (lh - img_height) // 2
     logo = logo.crop((left, top, left + img_height, top + img_height))
 
-
     # compute how many bars the logo occupies
     logo_width_in_bars = max(1, round(logo.width / barWidth))
-    # insert empty bars into data array after finder pattern, insert() arguments are (index, value)
-    for _ in range(logo_width_in_bars):
-        arrayCpy.insert(3, 0)
-
-    # compute full image width based on updated array
-    img_width = len(arrayCpy) * barWidth
-    # create blank barcode image
-    img = Image.new('RGB', (img_width, img_height), 'white')
-    draw = ImageDraw.Draw(img)
-    n = len(arrayCpy)
-
-    # draw each bar according to array value
-    for i, byte in enumerate(arrayCpy):
-        if i in (0, 2, n - 1):
-            rgb = (0, 0, 0)
-        elif i == 1:
-            hue = (byte / 255.0) * 360
-            rgb = tuple(int(c * 255) for c in colorsys.hsv_to_rgb(hue / 360.0, 1.0, 1.0))
-        elif byte in (0, 255):
-            rgb = (255, 255, 255)
-        else:
-            hue = (byte / 255.0) * 360
-            rgb = tuple(int(c * 255) for c in colorsys.hsv_to_rgb(hue / 360.0, 1.0, 1.0))
-        x0 = i * barWidth
-        draw.rectangle([x0, 0, x0 + barWidth, img_height], fill=rgb)
 
+    # finder bars and logo gap, the ecc bar is left black and painted per symbol
+    # a logo wider than its gap also covers the first data bars, as before
+    prefix_width = max((3 + logo_width_in_bars) * barWidth, 3 * barWidth + logo.width)
+    prefix = Image.new('RGB', (prefix_width, img_height), 'white')
+    prefix.paste((0, 0, 0), (0, 0, 3 * barWidth, img_height))
     # paste the prepared logo after the three finder bars
-    x_position = barWidth * 3
-    img.paste(logo, (x_position, 0))
+    prefix.paste(logo, (barWidth * 3, 0))
+    return logo, prefix, logo_width_in_bars
+
+def logo_cache_info():
+    # hits, misses, maxsize and currsize of the logo/prefix cache
+    return get_symbol_prefix.cache_info()
+
+def stacked_bar_colors(array, rows, logo_width_in_bars):
+    # (rows, bars) colors of a stacked symbol: finder, logo gap and header bar span the full height,
+    # then every row has its indicator bar and its share of the codeword, and the end bar closes them all
+    symbol = np.frombuffer(bytes(array), dtype=np.uint8)
+    data = stack_codeword(symbol[3:-1], rows)
+    indicators = np.array([row_indicator(row, rows) for row in range(rows)], dtype=np.uint8)
+    full_height = np.concatenate((symbol[:3], np.zeros(logo_width_in_bars, dtype=np.uint8)))
+    colors = np.concatenate((
+        np.broadcast_to(DATA_PALETTE[full_height], (rows, len(full_height), 3)),
+        np.broadcast_to(HUE_PALETTE[row_count_code(rows)], (rows, 1, 3)),
+        HUE_PALETTE[indicators][:, np.newaxis],
+        DATA_PALETTE[data],
+        np.zeros((rows, 1, 3), dtype=np.uint8),
+    ), axis=1)
+    colors[:, 1] = HUE_PALETTE[symbol[1]]
+    return colors
+
+@stage('render')
+def get_array_image(array, barWidth, img_height, logo_path=DEFAULT_LOGO_PATH, rows=1):
+    # rows > 1 renders the stacked layout: the same symbol array in a few short rows instead of one long one
+    if not 1 <= rows <= min(MAX_STACK_ROWS, img_height):
+        raise ValueError(f"Row count must be between 1 and {min(MAX_STACK_ROWS, img_height)}, got {rows}.")
+    logo_path = os.path.abspath(logo_path)
+    _, prefix, logo_width_in_bars = get_symbol_prefix(logo_path, os.path.getmtime(logo_path), img_height, barWidth)
+
+    if rows > 1:
+        colors = stacked_bar_colors(array, rows, logo_width_in_bars)
+    else:
+        # the logo gap bars stay blank, the cached prefix is pasted over them afterwards
+        row = np.frombuffer(bytes(array), dtype=np.uint8)
+        row = np.concatenate((row[:3], np.zeros(logo_width_in_bars, dtype=np.uint8), row[3:]))
+
+        # look up every bar color at once, then set the ecc and end bars
+        colors = DATA_PALETTE[row]
+        colors[1] = HUE_PALETTE[row[1]]
+        colors[-1] = 0
+        colors = colors[np.newaxis]
+    n = colors.shape[1]
+
+    # build one pixel per bar and row and stretch it to full size
+    scanline = Image.fromarray(np.ascontiguousarray(colors))
+    img = scanline.resize((n * barWidth, img_height), Image.Resampling.NEAREST)
+
+    # the prefix covers the finder bars and the logo, the ecc bar is painted back on top
+    img.paste(prefix, (0, 0))
+    img.paste(tuple(int(c) for c in colors[0, 1]), (barWidth, 0, 2 * barWidth, img_height))
 
     return img
 
@@ -66,25 +140,61 @@ def save_image(image, filename):
 def load_image(filename):
     return Image.open(filename)
 
-def simulate_image_noise(image, noise_level=0.1):
-    # get pixel map for random noise insertion
-    pixels = image.load()
-    width, height = image.size
-    # corrupt a fraction of pixels with random colors
-    for _ in range(int(width * height * noise_level)):
-        x = random.randint(0, width - 1)
-        y = random.randint(0, height - 1)
-        pixels[x, y] = (random.randint(0, 255),
-                        random.randint(0, 255),
-                        random.randint(0, 255))
-    # apply a random rotation for testing
-    rotation = random.choice([0, 90, 180, 270])
-
-    # Scale the image to a random size
-    
-    scale_factor = random.uniform(0.8, 1.2)
-    #scale_factor = 1
+def salt_and_pepper(image, rng, amount=0.1):
+    # corrupt a fraction of pixels with random colors, positions may repeat
+    pixels = np.array(image.convert('RGB'))
+    height, width = pixels.shape[:2]
+    count = int(width * height * amount)
+    ys = rng.integers(0, height, count)
+    xs = rng.integers(0, width, count)
+    pixels[ys, xs] = rng.integers(0, 256, (count, 3), dtype=np.uint8)
+    return Image.fromarray(pixels)
+
+def gaussian_noise(image, rng, sigma=10.0):
+    # add zero-mean gaussian noise to every channel
+    pixels = np.asarray(image.convert('RGB'), dtype=np.float32)
+    pixels = pixels + rng.normal(0.0, sigma, pixels.shape).astype(np.float32)
+    return Image.fromarray(np.clip(np.rint(pixels), 0, 255).astype(np.uint8))
+
+def blur(image, rng, radius=1.0):
+    # gaussian blur, as from an out of focus camera
+    return image.filter(ImageFilter.GaussianBlur(radius))
+
+def jpeg_recompress(image, rng, quality=75):
+    # round-trip through an in-memory jpeg
+    buffer = io.BytesIO()
+    image.convert('RGB').save(buffer, format='JPEG', quality=quality)
+    buffer.seek(0)
+    return Image.open(buffer).convert('RGB')
+
+def random_scale(image, rng, low=0.8, high=1.2):
+    # scale the image to a random size
+    scale_factor = rng.uniform(low, high)
     new_width = int(image.width * scale_factor)
     new_height = int(image.height * scale_factor)
-    image = image.resize((new_width, new_height), Image.Resampling.NEAREST)
-    return image.rotate(rotation, expand=True)
+    return image.resize((new_width, new_height), Image.Resampling.NEAREST)
+
+def random_rotation(image, rng, angles=(0, 90, 180, 270)):
+    # rotate by one of the given angles, corners uncovered by other angles are white
+    angle = float(rng.choice(angles))
+    return image.rotate(angle, expand=True, fillcolor='white')
+
+def random_skew(image, rng, max_angle=15.0):
+    # rotate by any angle up to max_angle either way, like a label held crooked under the scanner
+    angle = float(rng.uniform(-max_angle, max_angle))
+    return image.rotate(angle, expand=True, fillcolor='white', resample=Image.Resampling.BILINEAR)
+
+def apply_noise(image, stages, seed=None):
+    # run the image through each stage(image, rng) in order, seed can be an int or a numpy Generator
+    rng = np.random.default_rng(seed)
+    for stage in stages:
+        image = stage(image, rng)
+    return image
+
+def default_noise_stages(noise_level=0.1):
+    # random pixels, then a random scale and a quarter turn
+    return [partial(salt_and_pepper, amount=noise_level), random_scale, random_rotation]
+
+@stage('noise')
+def simulate_image_noise(image, noise_level=0.1, seed=None):
+    return apply_noise(image, default_noise_stages(noise_level), seed)
@@ -0,0 +1,316 @@
+import argparse
+import glob
+import io
+import itertools
+import json
+import os
+import sys
+import tarfile
+import time
+import zipfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+from PIL import Image
+
+from barcode_drawer import get_array_image, DEFAULT_LOGO_PATH
+from compression import compress_payload, decompress_payload
+from encoder import decode_data_with_confidence
+from pipeline import build_symbol, read_deskewed, DEFAULT_BAR_WIDTH, DEFAULT_BAR_HEIGHT
+from planner import plan_symbol, plan_ecc, plan_array_size, DEFAULT_NOISE_LEVEL, DEFAULT_TARGET_SUCCESS
+from utils import read_array_and_confidence, get_data_from_array
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.gif', '.tif', '.tiff', '.webp')
+
+
+def read_payloads(stream, input_format='lines'):
+    # yield (name, payload bytes) one at a time so huge inputs are never held in memory
+    for index, line in enumerate(stream):
+        line = line.rstrip('\r\n')
+        if not line:
+            continue
+        name = f"{index:08d}"
+        try:
+            if input_format == 'jsonl':
+                # a JSON string, or an object with "data" and an optional "name"
+                record = json.loads(line)
+                if isinstance(record, dict):
+                    name = label_name(record.get('name'), name)
+                    record = record['data']
+                line = record
+            payload = line.encode('latin-1')
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            # one bad line is reported and skipped, the rest of a long input still gets encoded
+            print(f"line {index + 1}: skipped, {type(e).__name__}: {e}", file=sys.stderr)
+            continue
+        yield name, payload
+
+
+def label_name(name, default):
+    # a JSONL name is only a file name: directories are dropped so a label never lands outside the output,
+    # and names that are nothing but a directory fall back to the line number
+    if name is None:
+        return default
+    name = os.path.basename(str(name).replace('\\', '/').replace('\x00', ''))
+    return default if name in ('', '.', '..') else name
+
+
+def plan_label(payload, noise_level, target_success, compress=True, array_size=None, error_correction_level=None):
+    # size the symbol for the bytes that will actually be stored, a fixed array size or ecc level is kept
+    # and the planner picks the other one
+    length = len(compress_payload(payload) if compress else payload)
+    if array_size is not None and error_correction_level is not None:
+        # both fixed: the encoder would truncate a payload that does not fit, so it is turned down here
+        if length > array_size - 4 - error_correction_level:
+            raise ValueError(f"Payload of {length} bytes does not fit an array of size {array_size} "
+                             f"at ecc level {error_correction_level}.")
+        return array_size, error_correction_level
+    if array_size is not None:
+        return array_size, plan_ecc(length, array_size, noise_level, target_success)
+    if error_correction_level is not None:
+        return plan_array_size(length, error_correction_level), error_correction_level
+    return plan_symbol(length, noise_level, target_success)
+
+
+def render_labels(items, array_size, barWidth, barHeight, error_correction_level, logo_path, compress=True,
+                  noise_level=DEFAULT_NOISE_LEVEL, target_success=DEFAULT_TARGET_SUCCESS, rows=1):
+    # worker task: encode and render a chunk of payloads to PNG bytes,
+    # array_size and error_correction_level set to None are planned per payload, fixed ones against the payload length
+    labels = []
+    for name, payload in items:
+        try:
+            size, ecc = plan_label(payload, noise_level, target_success, compress, array_size, error_correction_level)
+            symbol = build_symbol(payload, size, ecc, compress)
+            image = get_array_image(symbol, barWidth, barHeight, logo_path, rows)
+        except ValueError as e:
+            # a payload no symbol can carry is reported and skipped, the rest of the run goes on
+            print(f"{name}: skipped, {e}", file=sys.stderr)
+            continue
+        buffer = io.BytesIO()
+        image.save(buffer, format='PNG')
+        labels.append((f"{name}.png", buffer.getvalue()))
+    return labels
+
+
+def find_images(patterns):
+    # yield image files from directories (walked recursively) and glob patterns, lazily
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            for root, dirs, files in os.walk(pattern):
+                dirs.sort()
+                for filename in sorted(files):
+                    if filename.lower().endswith(IMAGE_EXTENSIONS):
+                        yield os.path.join(root, filename)
+        else:
+            yield from sorted(glob.iglob(pattern, recursive=True))
+
+
+def decode_file(path):
+    # run one scan through the decoder, timing every stage
+    return {'file': path, **decode_stream(path)}
+
+
+def decode_stream(source):
+    # decode a file path or an open binary stream holding an encoded image
+    result = {}
+    timings = {}
+    try:
+        start = time.perf_counter()
+        with Image.open(source) as image:
+            image = image.convert('RGB')
+        timings['load'] = time.perf_counter() - start
+
+        def read(skew):
+            # a deskewed retry adds its stage times to the first attempt's
+            start = time.perf_counter()
+            read_array, confidence = read_array_and_confidence(image, skew=skew)
+            timings['read'] = timings.get('read', 0.0) + time.perf_counter() - start
+
+            start = time.perf_counter()
+            data_chunk, ecc = get_data_from_array(read_array)
+            timings['extract'] = timings.get('extract', 0.0) + time.perf_counter() - start
+            result['ecc_level'] = ecc
+
+            start = time.perf_counter()
+            decoded, corrected = decode_data_with_confidence(data_chunk, ecc, confidence[3:3 + len(data_chunk)])
+            decoded = decompress_payload(decoded)
+            timings['decode'] = timings.get('decode', 0.0) + time.perf_counter() - start
+            return decoded, corrected
+
+        (decoded, corrected), skew = read_deskewed(image, read, timings)
+        if skew:
+            result['skew'] = skew
+        result['payload'] = decoded.decode('latin-1').rstrip('\x00')
+        result['corrected'] = corrected
+        result['ok'] = True
+    except Exception as e:
+        # report the failure for this file and keep going, whatever broke
+        result['ok'] = False
+        result['error'] = f"{type(e).__name__}: {e}"
+    result['timings_ms'] = {stage: round(elapsed * 1000, 3) for stage, elapsed in timings.items()}
+    return result
+
+
+def decode_files(paths):
+    # worker task: decode a chunk of image files
+    return [decode_file(path) for path in paths]
+
+
+class LabelWriter:
+    # writes labels to a directory, or to a single .zip / .tar archive
+
+    def __init__(self, output=None, archive=None):
+        self.output = output
+        self.archive = None
+        self.written = set()
+        if archive is not None and archive.endswith('.zip'):
+            self.archive = zipfile.ZipFile(archive, 'w', compression=zipfile.ZIP_STORED)
+        elif archive is not None:
+            self.archive = tarfile.open(archive, 'w')
+        elif output is not None:
+            os.makedirs(output, exist_ok=True)
+
+    def unique(self, filename):
+        # a repeated label name gets a counter before its extension instead of overwriting the earlier label
+        stem, extension = os.path.splitext(filename)
+        candidate, count = filename, 1
+        while candidate in self.written:
+            candidate = f"{stem}-{count}{extension}"
+            count += 1
+        if candidate != filename:
+            print(f"{filename}: name already used, written as {candidate}", file=sys.stderr)
+        self.written.add(candidate)
+        return candidate
+
+    def write(self, filename, data):
+        filename = self.unique(filename)
+        if isinstance(self.archive, zipfile.ZipFile):
+            self.archive.writestr(filename, data)
+        elif self.archive is not None:
+            info = tarfile.TarInfo(filename)
+            info.size = len(data)
+            info.mtime = int(time.time())
+            self.archive.addfile(info, io.BytesIO(data))
+        else:
+            with open(os.path.join(self.output, filename), 'wb') as f:
+                f.write(data)
+
+    def close(self):
+        if self.archive is not None:
+            self.archive.close()
+
+
+def run_pool(task, chunks, workers=None, max_in_flight=None):
+    # submit chunks to a process pool with at most max_in_flight pending, results come back in input order
+    max_in_flight = max_in_flight or 4 * (workers or os.cpu_count() or 1)
+    pending = deque()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for chunk in chunks:
+            if len(pending) >= max_in_flight:
+                yield pending.popleft().result()
+            pending.append(pool.submit(task, chunk))
+        while pending:
+            yield pending.popleft().result()
+
+
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def open_input(path):
+    # payloads are latin-1 text like in main.py, so every input byte maps to one payload byte
+    if path == '-':
+        return io.TextIOWrapper(sys.stdin.buffer, encoding='latin-1')
+    return open(path, encoding='latin-1')
+
+
+def encode_command(args):
+    stream = open_input(args.input)
+    writer = LabelWriter(args.output, args.archive)
+    # the planner picks whichever of array size and ecc level is not given, per payload
+    task = partial(render_labels, array_size=args.array_size, barWidth=args.bar_width, barHeight=args.bar_height,
+                   error_correction_level=args.ecc_level, logo_path=os.path.abspath(args.logo),
+                   compress=not args.no_compress, noise_level=args.noise_level, target_success=args.target_success,
+                   rows=args.rows)
+    count = 0
+    start = time.perf_counter()
+    try:
+        chunks = chunked(read_payloads(stream, args.format), args.chunk_size)
+        for labels in run_pool(task, chunks, args.workers, args.max_in_flight):
+            for filename, data in labels:
+                writer.write(filename, data)
+            count += len(labels)
+    finally:
+        writer.close()
+        stream.close()
+    elapsed = time.perf_counter() - start
+    print(f"{count} labels in {elapsed:.2f} s ({count / elapsed if elapsed else 0:.1f} labels/s)", file=sys.stderr)
+
+
+def decode_command(args):
+    out = sys.stdout if args.output == '-' else open(args.output, 'w')
+    count = failures = 0
+    start = time.perf_counter()
+    try:
+        chunks = chunked(find_images(args.inputs), args.chunk_size)
+        for results in run_pool(decode_files, chunks, args.workers, args.max_in_flight):
+            for result in results:
+                out.write(json.dumps(result) + '\n')
+                failures += not result['ok']
+            count += len(results)
+            out.flush()
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    elapsed = time.perf_counter() - start
+    print(f"{count} images in {elapsed:.2f} s ({count / elapsed if elapsed else 0:.1f} images/s), "
+          f"{failures} failed", file=sys.stderr)
+
+
+def add_pool_arguments(parser):
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--chunk-size', type=int, default=64, help="items per worker task")
+    parser.add_argument('--max-in-flight', type=int, default=None, help="pending tasks, default 4 per worker")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Non-interactive batch barcode tools.")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    encode = commands.add_parser('encode', help="render one label per input payload")
+    encode.add_argument('input', nargs='?', default='-', help="payload file, '-' for stdin")
+    encode.add_argument('--format', choices=('lines', 'jsonl'), default='lines')
+    target = encode.add_mutually_exclusive_group(required=True)
+    target.add_argument('--output', help="directory for the PNG labels")
+    target.add_argument('--archive', help="single .zip or .tar file for the PNG labels")
+    encode.add_argument('--array-size', type=int, help="fixed array size, planned per payload by default")
+    encode.add_argument('--bar-width', type=int, default=DEFAULT_BAR_WIDTH)
+    encode.add_argument('--bar-height', type=int, default=DEFAULT_BAR_HEIGHT)
+    encode.add_argument('--rows', type=int, default=1, help="stack the bars of each label in this many rows")
+    encode.add_argument('--ecc-level', type=int, help="fixed ecc level, planned per payload by default")
+    encode.add_argument('--noise-level', type=float, default=DEFAULT_NOISE_LEVEL, help="expected scan noise for the planner")
+    encode.add_argument('--target-success', type=float, default=DEFAULT_TARGET_SUCCESS,
+                        help="decode success rate the planner aims for")
+    encode.add_argument('--logo', default=DEFAULT_LOGO_PATH)
+    encode.add_argument('--no-compress', action='store_true', help="always store payloads raw")
+    add_pool_arguments(encode)
+    encode.set_defaults(run=encode_command)
+
+    decode = commands.add_parser('decode', help="decode every image in directories or glob patterns")
+    decode.add_argument('inputs', nargs='+', help="directories (walked recursively) or glob patterns")
+    decode.add_argument('--output', default='-', help="JSONL results file, '-' for stdout")
+    add_pool_arguments(decode)
+    decode.set_defaults(run=decode_command, chunk_size=16)
+
+    args = parser.parse_args(argv)
+    args.run(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,209 @@
+import argparse
+import itertools
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+import timeit
+
+import numpy as np
+import PIL
+
+from barcode_drawer import set_finder_pattern, get_array_image, simulate_image_noise
+from encoder import encode_data, decode_data, RS_BACKEND, ReedSolomonError
+from pipeline import encode_to_image, decode_from_image
+from utils import format_image, get_array_from_image
+
+# reproducible matrix: payloads come from the fixture file, noise and damage from fixed seeds
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench_fixtures')
+PAYLOAD_FIXTURE = os.path.join(FIXTURE_DIR, 'payload.txt')
+ARRAY_SIZES = (50, 150, 500, 2000)
+QUICK_ARRAY_SIZES = (50, 150)
+BAR_WIDTHS = (4, 20)
+ECC_LEVELS = (10, 40)
+BAR_HEIGHT = 100
+NOISE_LEVEL = 0.05
+SEED = 1234
+DEFAULT_HISTORY = 'bench_history.jsonl'
+# a case this much slower than the previous run on the same machine counts as a regression
+DEFAULT_THRESHOLD = 1.25
+MIN_RUN_TIME = 0.1
+REPEAT = 5
+
+
+def load_payload(size, ecc):
+    # fixture text cut to what one symbol can carry
+    with open(PAYLOAD_FIXTURE, 'rb') as f:
+        return f.read()[:size - 4 - ecc]
+
+
+def build_symbol_array(payload, size, ecc):
+    array = bytearray(size)
+    array[3:-1] = encode_data(payload, size, ecc)
+    set_finder_pattern(array, ecc)
+    return array
+
+
+def damage(codeword, ecc, seed=SEED):
+    # flip a quarter of the correctable bytes, well inside what reed-solomon repairs
+    rng = np.random.default_rng(seed)
+    damaged = bytearray(codeword)
+    for pos in rng.choice(len(damaged), size=max(1, ecc // 4), replace=False):
+        damaged[pos] ^= int(rng.integers(1, 256))
+    return damaged
+
+
+def cases(array_sizes=ARRAY_SIZES, bar_widths=BAR_WIDTHS, ecc_levels=ECC_LEVELS):
+    # yield (name, params, callable) for every public function and the round trip over the matrix
+    for size, ecc in itertools.product(array_sizes, ecc_levels):
+        if size - 4 - ecc <= 0:
+            continue
+        payload = load_payload(size, ecc)
+        codeword = encode_data(payload, size, ecc)
+        damaged = damage(codeword, ecc)
+        params = {'array_size': size, 'ecc': ecc}
+        yield 'encode_data', params, lambda p=payload, s=size, e=ecc: encode_data(p, s, e)
+        yield 'decode_data clean', params, lambda c=codeword, e=ecc: decode_data(c, e)
+        yield 'decode_data damaged', params, lambda c=damaged, e=ecc: decode_data(c, e)
+
+        array = build_symbol_array(payload, size, ecc)
+        for width in bar_widths:
+            params = {'array_size': size, 'bar_width': width, 'ecc': ecc}
+            image = get_array_image(array, width, BAR_HEIGHT)
+            # the resize based reader only copes with clean images, the round trip covers noisy ones
+            rotated = image.rotate(90, expand=True)
+            formatted = format_image(image, image.width)
+            yield 'get_array_image', params, lambda a=array, w=width: get_array_image(a, w, BAR_HEIGHT)
+            yield 'simulate_image_noise', params, lambda i=image: simulate_image_noise(i, NOISE_LEVEL, seed=SEED)
+            yield 'format_image', params, lambda i=rotated, w=image.width: format_image(i, w)
+            yield 'get_array_from_image', params, lambda i=formatted, w=width: get_array_from_image(i, w, BAR_HEIGHT)
+            yield 'round trip', params, lambda p=payload, s=size, w=width, e=ecc: round_trip(p, s, w, e)
+
+
+def round_trip(payload, size, width, ecc):
+    # encode -> render -> noise -> scan -> decode, as a scanner sees it; a failed read is timed too
+    image = encode_to_image(payload, size, width, BAR_HEIGHT, ecc)
+    try:
+        return decode_from_image(simulate_image_noise(image, NOISE_LEVEL, seed=SEED)) == payload
+    except (ValueError, ReedSolomonError):
+        return False
+
+
+def time_case(func):
+    # calls per repeat sized like timeit's autorange, best and median time per call over the repeats
+    number, _ = timeit.Timer(func).autorange()
+    number = max(1, int(number * MIN_RUN_TIME / 0.2))
+    runs = [elapsed / number for elapsed in timeit.repeat(func, number=number, repeat=REPEAT)]
+    return {'best': min(runs), 'median': statistics.median(runs), 'number': number}
+
+
+def case_key(name, params):
+    return name + '[' + ','.join(f"{key}={value}" for key, value in params.items()) + ']'
+
+
+def git_revision():
+    # commit and dirty flag of the tree being measured, None outside a git checkout
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], capture_output=True, text=True,
+                               check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() != ''
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit, dirty
+
+
+def machine():
+    # results are only compared between runs with the same fingerprint
+    return {
+        'node': platform.node(),
+        'machine': platform.machine(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'pillow': PIL.__version__,
+        'rs_backend': RS_BACKEND,
+    }
+
+
+def run_suite(array_sizes=ARRAY_SIZES, name_filter=None, out=sys.stdout):
+    results = {}
+    for name, params, func in cases(array_sizes):
+        key = case_key(name, params)
+        if name_filter and name_filter not in key:
+            continue
+        results[key] = timing = time_case(func)
+        if name == 'round trip':
+            timing['ok'] = bool(func())
+        status = '' if timing.get('ok', True) else '  decode failed'
+        print(f"{key:<60} {timing['best'] * 1000:10.3f} ms  (median {timing['median'] * 1000:.3f}){status}", file=out)
+    return results
+
+
+def load_history(path):
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def previous_runs(history, fingerprint):
+    # earlier runs on this machine, newest first
+    return [entry for entry in reversed(history) if entry['machine'] == fingerprint]
+
+
+def compare(results, previous, threshold=DEFAULT_THRESHOLD, out=sys.stdout):
+    # ratio of best times against the newest earlier run of each case, filtered runs only hold some cases;
+    # returns the keys that got slower than the threshold or stopped decoding
+    regressions = []
+    for key, timing in results.items():
+        entry = next((entry for entry in previous if key in entry['results']), None)
+        if entry is None:
+            continue
+        old = entry['results'][key]
+        ratio = timing['best'] / old['best']
+        flag = ''
+        if ratio > threshold:
+            flag = '  REGRESSION'
+            regressions.append(key)
+        if timing.get('ok') is False and old.get('ok'):
+            flag += '  NO LONGER DECODES'
+            regressions.append(key)
+        print(f"{key:<60} {ratio:6.2f}x vs {entry['commit']}{flag}", file=out)
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Reproducible encode / decode benchmark suite with saved history.")
+    parser.add_argument('--quick', action='store_true', help=f"only array sizes {QUICK_ARRAY_SIZES}")
+    parser.add_argument('--filter', help="only cases whose name contains this text")
+    parser.add_argument('--history', default=DEFAULT_HISTORY, help="JSONL file every run is appended to")
+    parser.add_argument('--no-save', action='store_true', help="do not append this run to the history")
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD, help="slowdown ratio reported as regression")
+    parser.add_argument('--fail-on-regression', action='store_true', help="exit with status 1 when a case regressed")
+    args = parser.parse_args(argv)
+
+    fingerprint = machine()
+    commit, dirty = git_revision()
+    results = run_suite(QUICK_ARRAY_SIZES if args.quick else ARRAY_SIZES, args.filter)
+
+    previous = previous_runs(load_history(args.history), fingerprint)
+    regressions = []
+    if previous:
+        print("compared to earlier runs on this machine ==========")
+        regressions = compare(results, previous, args.threshold)
+    if not args.no_save:
+        entry = {'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'commit': commit, 'dirty': dirty,
+                 'machine': fingerprint, 'results': results}
+        with open(args.history, 'a') as f:
+            f.write(json.dumps(entry) + '\n')
+    if regressions:
+        print(f"{len(regressions)} regression(s) over {args.threshold}x", file=sys.stderr)
+        if args.fail_on_regression:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,485 @@
+import colorsys
+import random
+import timeit
+from functools import partial
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+from barcode_drawer import (DEFAULT_LOGO_PATH, set_finder_pattern, get_array_image, simulate_image_noise, apply_noise,
+                            salt_and_pepper, gaussian_noise, blur, random_scale, random_rotation, random_skew)
+from encoder import (encode_data, decode_data, encode_many, decode_many, load_rs_backend, RSCodec, RS_BACKEND, RS_BACKENDS,
+                     ReedSolomonError, get_codec, correct_with_codec)
+from pipeline import build_symbol, decode_from_image, read_and_decode
+from locate import locate_symbols, decode_scene
+from stream import FrameDecoder
+from structured import encode_structured, Reassembler
+from utils import format_image, get_array_from_image, get_data_from_array, read_array_from_image, classify_colors, classify_hsv
+
+barHeight = 100
+arraySize = 150
+barWidth = 20
+error_correction_level = 80
+input_string = "Hello, World! This is a rather long string - Once upon a time..."
+
+
+def legacy_get_array_from_image(image, barWidth, barHeight):
+    # original per-pixel sampler, kept as the reference for the vectorized one
+    image = image.convert('RGB')
+    w, h = image.size
+    n = w // barWidth
+    px = image.load()
+    array = bytearray(n)
+    for i in range(n):
+        r_sum = g_sum = b_sum = 0
+        x0 = i * barWidth
+        for dx in range(barWidth):
+            for y in range(h):
+                r, g, b = px[x0 + dx, y]
+                r_sum += r
+                g_sum += g
+                b_sum += b
+        count = barWidth * h
+        h_, s_, v_ = colorsys.rgb_to_hsv(r_sum // count / 255.0,
+                                         g_sum // count / 255.0,
+                                         b_sum // count / 255.0)
+        if v_ < 0.1 or (v_ > 0.9 and s_ < 0.1):
+            array[i] = 0
+        else:
+            array[i] = int(round(h_ * 255))
+    logo_width_in_bars = barHeight // barWidth
+    return array[:3] + array[3 + logo_width_in_bars:]
+
+
+def legacy_get_array_image(array, barWidth, img_height):
+    # original one-rectangle-per-bar renderer, kept as the reference for the palette one
+    arrayCpy = array.copy()
+    logo = Image.open(DEFAULT_LOGO_PATH)
+    w0, h0 = logo.size
+    scale = img_height / min(w0, h0)
+    logo = logo.resize((int(w0 * scale), int(h0 * scale)), Image.Resampling.LANCZOS)
+    lw, lh = logo.size
+    left = (lw - img_height) // 2
+    top = (lh - img_height) // 2
+    logo = logo.crop((left, top, left + img_height, top + img_height))
+    logo_width_in_bars = max(1, round(logo.width / barWidth))
+    for _ in range(logo_width_in_bars):
+        arrayCpy.insert(3, 0)
+    img = Image.new('RGB', (len(arrayCpy) * barWidth, img_height), 'white')
+    draw = ImageDraw.Draw(img)
+    n = len(arrayCpy)
+    for i, byte in enumerate(arrayCpy):
+        if i in (0, 2, n - 1):
+            rgb = (0, 0, 0)
+        elif i == 1 or byte not in (0, 255):
+            hue = (byte / 255.0) * 360
+            rgb = tuple(int(c * 255) for c in colorsys.hsv_to_rgb(hue / 360.0, 1.0, 1.0))
+        else:
+            rgb = (255, 255, 255)
+        x0 = i * barWidth
+        draw.rectangle([x0, 0, x0 + barWidth, img_height], fill=rgb)
+    img.paste(logo, (barWidth * 3, 0))
+    return img
+
+
+def legacy_format_image(image, expected_width):
+    # original four-way rotation search, kept as the reference for the single-pass one
+    for angle in (0, 90, 180, 270):
+        cand = image.rotate(angle, expand=True)
+        gray = cand.convert('L', dither=Image.NONE)
+        w, h = gray.size
+        px = gray.load()
+        mid_y = h // 2
+        start = next((x for x in range(w) if px[x, mid_y] < 128), None)
+        if start is None:
+            continue
+        end = next((x for x in range(start+1, w) if px[x, mid_y] >= 128), None)
+        if end is None:
+            continue
+        bar_w = end - start
+        if start + 2*bar_w + bar_w//2 >= w:
+            continue
+        rgb = cand.convert('RGB').load()
+        centers = [rgb[start + bar_w//2, mid_y],
+                   rgb[start + bar_w + bar_w//2, mid_y],
+                   rgb[start + 2*bar_w + bar_w//2, mid_y]]
+        def is_black(c): return sum(c)/3 < 64
+        def is_colored(c):
+            h_, s_, v_ = colorsys.rgb_to_hsv(c[0]/255, c[1]/255, c[2]/255)
+            return s_ > 0.5 and v_ > 0.5
+        if is_black(centers[0]) and is_colored(centers[1]) and is_black(centers[2]):
+            rotation = angle
+            break
+    else:
+        raise ValueError("Could not detect rotation/finder pattern")
+    image = image.rotate(rotation, expand=True, resample=Image.Resampling.NEAREST)
+    width, height = image.size
+    rescale_ratio = expected_width / width
+    return image.resize((round(width * rescale_ratio), round(height * rescale_ratio)), Image.Resampling.NEAREST)
+
+
+def legacy_simulate_image_noise(image, noise_level=0.1):
+    # original per-pixel noise loop, kept as the reference for the vectorized stages
+    image = image.copy()
+    pixels = image.load()
+    width, height = image.size
+    for _ in range(int(width * height * noise_level)):
+        x = random.randint(0, width - 1)
+        y = random.randint(0, height - 1)
+        pixels[x, y] = (random.randint(0, 255), random.randint(0, 255), random.randint(0, 255))
+    rotation = random.choice([0, 90, 180, 270])
+    scale_factor = random.uniform(0.8, 1.2)
+    image = image.resize((int(image.width * scale_factor), int(image.height * scale_factor)), Image.Resampling.NEAREST)
+    return image.rotate(rotation, expand=True)
+
+
+def build_array(size=arraySize, ecc=error_correction_level):
+    # encode the default test string into a full symbol array
+    encoded = encode_data(input_string.encode('latin-1'), size, ecc)
+    array = bytearray(size)
+    array[3:-1] = encoded
+    set_finder_pattern(array, ecc)
+    return array
+
+
+def build_image(size=arraySize, width=barWidth, height=barHeight, ecc=error_correction_level):
+    # render a clean barcode for the default test string
+    return get_array_image(build_array(size, ecc), width, height)
+
+
+def report(name, func, number):
+    # print the best average time per call over a few repeats
+    best = min(timeit.repeat(func, number=number, repeat=3)) / number
+    print(f"{name:<40} {best * 1000:10.3f} ms")
+    return best
+
+
+def bench_sampler(number=5):
+    image = build_image()
+    # both samplers must agree before timing means anything
+    assert get_array_from_image(image, barWidth, barHeight) == legacy_get_array_from_image(image, barWidth, barHeight)
+    print("get_array_from_image ==================")
+    legacy = report("legacy loop", lambda: legacy_get_array_from_image(image, barWidth, barHeight), number)
+    fast = report("numpy", lambda: get_array_from_image(image, barWidth, barHeight), number)
+    print(f"speedup: {legacy / fast:.1f}x")
+
+
+def bench_classify(bars=500, number=200, seed=0):
+    # table gather against the hsv math it was built from, on random averaged bar colors
+    rgb_avg = np.random.default_rng(seed).integers(0, 256, (bars, 3))
+    assert (classify_colors(rgb_avg) == classify_hsv(rgb_avg)).all()
+    print("classify_colors =======================")
+    hsv = report(f"hsv thresholds x{bars}", lambda: classify_hsv(rgb_avg), number)
+    table = report(f"table gather x{bars}", lambda: classify_colors(rgb_avg), number)
+    print(f"speedup: {hsv / table:.1f}x")
+
+
+def bench_renderer(number=20):
+    array = build_array()
+    # the palette renderer must stay pixel-identical to the rectangle one
+    assert get_array_image(array, barWidth, barHeight).tobytes() == legacy_get_array_image(array, barWidth, barHeight).tobytes()
+    print("get_array_image =======================")
+    legacy = report("legacy rectangles", lambda: legacy_get_array_image(array, barWidth, barHeight), number)
+    fast = report("palette scanline", lambda: get_array_image(array, barWidth, barHeight), number)
+    print(f"speedup: {legacy / fast:.1f}x")
+
+
+def bench_codec(levels=(10, 80, 200), count=10):
+    print(f"reed-solomon codec ({RS_BACKEND}) =========")
+    for ecc in levels:
+        size = max(arraySize, ecc + 50)
+        data = input_string.encode('latin-1')[:size - 4 - ecc]
+        payloads = [data] * count
+        codewords = encode_many(payloads, size, ecc)
+        # a fresh RSCodec per call is what encode_data and decode_data used to do
+        report(f"ecc {ecc:3d} encode, new codec x{count}",
+               lambda: [RSCodec(ecc).encode(data) for _ in payloads], 1)
+        report(f"ecc {ecc:3d} encode_data x{count}",
+               lambda: [encode_data(data, size, ecc) for _ in payloads], 1)
+        report(f"ecc {ecc:3d} encode_many x{count}", lambda: encode_many(payloads, size, ecc), 1)
+        report(f"ecc {ecc:3d} decode, new codec x{count}",
+               lambda: [RSCodec(ecc).decode(codeword) for codeword in codewords], 1)
+        report(f"ecc {ecc:3d} decode_data x{count}",
+               lambda: [decode_data(codeword, ecc) for codeword in codewords], 1)
+        report(f"ecc {ecc:3d} decode_many x{count}", lambda: decode_many(codewords, ecc), 1)
+
+
+def bench_syndrome(levels=(10, 80, 200), count=20):
+    # clean codewords: the syndrome fast path against the backend's full decode
+    print(f"clean decode ({RS_BACKEND}) ==============")
+    for ecc in levels:
+        rsc = get_codec(ecc)
+        data = input_string.encode('latin-1')[:255 - ecc]
+        codeword = bytearray(rsc.encode(data))
+        assert correct_with_codec(rsc, codeword)[0] == data
+        full = report(f"rsc.decode ecc {ecc:3d} x{count}", lambda: [rsc.decode(codeword) for _ in range(count)], 1)
+        fast = report(f"syndrome check ecc {ecc:3d} x{count}",
+                      lambda: [correct_with_codec(rsc, codeword) for _ in range(count)], 1)
+        print(f"speedup: {full / fast:.1f}x")
+
+
+def bench_orientation(number=10, noise_level=0.01, seed=0):
+    print("format_image ==========================")
+    expected_width = arraySize * barWidth + barHeight
+    # noisy symbol, then each of the four orientations the scanner can see
+    image = simulate_image_noise(build_image(), noise_level, seed=seed)
+    for angle in (0, 90, 180, 270):
+        rotated = image.rotate(-angle, expand=True)
+        assert format_image(rotated, expected_width).tobytes() == legacy_format_image(rotated, expected_width).tobytes()
+        legacy = report(f"legacy search, rotated {angle:3d}", lambda: legacy_format_image(rotated, expected_width), number)
+        fast = report(f"single pass, rotated {angle:3d}", lambda: format_image(rotated, expected_width), number)
+        print(f"speedup: {legacy / fast:.1f}x")
+
+
+def bench_scanner(trials=50, noise_level=0.02, seed=0):
+    print("resize vs scanline decoding ===========")
+    expected_width = arraySize * barWidth + barHeight
+    rng = np.random.default_rng(seed)
+    images = [simulate_image_noise(build_image(), noise_level, seed=rng) for _ in range(trials)]
+    readers = {
+        "format_image + get_array_from_image":
+            lambda image: get_array_from_image(format_image(image, expected_width), barWidth, barHeight),
+        "read_array_from_image": read_array_from_image,
+    }
+    for name, reader in readers.items():
+        # random scales and noise, so count the symbols that still decode
+        decoded = 0
+        for image in images:
+            try:
+                data_chunk, ecc = get_data_from_array(reader(image))
+                decoded += decode_data(data_chunk, ecc) == input_string.encode('latin-1')
+            except (ValueError, ReedSolomonError):
+                pass
+        report(name, lambda: reader(images[0]), 10)
+        print(f"{'':<40} {decoded}/{trials} decoded")
+
+
+def build_frames(count=60, noise_level=0.02, sigma=10.0, seed=0):
+    # a fixed camera pose, then fresh pixel noise per frame; the label changes halfway through
+    rng = np.random.default_rng(seed)
+    frames = []
+    for payload in (input_string, input_string[::-1]):
+        symbol = build_array()
+        symbol[3:-1] = encode_data(payload.encode('latin-1'), arraySize, error_correction_level)
+        posed = apply_noise(get_array_image(symbol, barWidth, barHeight), [random_scale, random_rotation], rng)
+        stages = [partial(salt_and_pepper, amount=noise_level), partial(gaussian_noise, sigma=sigma)]
+        frames += [apply_noise(posed, stages, rng)
+                   for _ in range(count // 2)]
+    return frames
+
+
+def bench_stream(count=60, noise_level=0.02, sigma=10.0, seed=0):
+    print(f"frame stream decoding, noise {noise_level}, sigma {sigma} ==")
+    frames = build_frames(count, noise_level, sigma, seed)
+    per_frame = report(f"decode_from_image x{count}", lambda: [safe_decode(frame) for frame in frames], 1)
+    stream = report(f"FrameDecoder x{count}", lambda: decode_frames_with_stats(frames), 1)
+    payloads, stats = decode_frames_with_stats(frames)
+    print(f"{'':<40} {len(payloads)} payloads reported, {stats}")
+    print(f"speedup: {per_frame / stream:.1f}x")
+
+
+def decode_frames_with_stats(frames):
+    decoder = FrameDecoder()
+    payloads = [payload for payload in map(decoder.decode_frame, frames) if payload is not None]
+    return payloads, decoder.stats
+
+
+def safe_decode(frame):
+    try:
+        return decode_from_image(frame)
+    except (ValueError, ReedSolomonError):
+        return None
+
+
+def build_scene(count=24, width=6, noise_level=0.01, sigma=5.0, seed=0):
+    # a page scan: labels on a white A4 page at 300 dpi, two columns read across and a row read down,
+    # in all four directions
+    rng = np.random.default_rng(seed)
+    page = Image.new('RGB', (2480, 3508), 'white')
+    payloads = []
+    for index in range(count):
+        payload = f"label {index:03d} " + ''.join(chr(c) for c in rng.integers(97, 123, 30))
+        payloads.append(payload)
+        image = get_array_image(build_symbol(payload, arraySize, 40), width, barHeight)
+        if index < count * 2 // 3:
+            image = image.rotate(180 * (index % 2), expand=True)
+            position = (60 + (index % 2) * 1220, 60 + (index // 2) * 200)
+        else:
+            image = image.rotate(90 + 180 * (index % 2), expand=True)
+            position = (60 + (index - count * 2 // 3) * 300, 1700)
+        page.paste(image, position)
+    stages = [partial(salt_and_pepper, amount=noise_level), partial(gaussian_noise, sigma=sigma)]
+    return apply_noise(page, stages, rng), payloads
+
+
+def bench_scene(count=24, noise_level=0.01, seed=0):
+    print(f"page scan with {count} labels ============")
+    page, payloads = build_scene(count, noise_level=noise_level, seed=seed)
+    report("locate_symbols", lambda: locate_symbols(page), 3)
+    report("decode_scene", lambda: decode_scene(page), 1)
+    results = decode_scene(page)
+    found = {result['payload'] for result in results if result['ok']}
+    print(f"{'':<40} {len(results)} symbols found, {len(found & set(payloads))} of {count} labels decoded")
+
+
+def build_skew_set(count=40, max_angle=15.0, noise_level=0.01, seed=0):
+    # labels skewed by up to max_angle either way after a random quarter turn, then light pixel noise
+    rng = np.random.default_rng(seed)
+    labels = []
+    for index in range(count):
+        payload = f"label {index:03d} " + ''.join(chr(c) for c in rng.integers(97, 123, 30))
+        image = get_array_image(build_symbol(payload, arraySize, 40), int(rng.choice((6, 10, 20))), barHeight)
+        stages = [random_rotation, partial(random_skew, max_angle=max_angle), partial(salt_and_pepper, amount=noise_level)]
+        labels.append((payload.encode('latin-1'), apply_noise(image, stages, rng)))
+    return labels
+
+
+def bench_skew(count=40, max_angle=15.0, seed=0):
+    print(f"skewed labels, up to {max_angle} degrees ==")
+    labels = build_skew_set(count, max_angle, seed=seed)
+    for name, decode in (("axis-aligned scanlines", read_and_decode), ("with deskew", decode_from_image)):
+        decoded = []
+        elapsed = report(f"{name} x{count}", lambda: decoded.append(sum(try_decode(decode, image) == payload
+                                                                            for payload, image in labels)), 1)
+        print(f"{'':<40} {decoded[-1]} of {count} decoded, {decoded[-1] / elapsed:.1f} labels/s")
+    # frames without a label are the common case for a camera, they must fail about as fast as the plain read
+    for name, frame in build_empty_frames(seed):
+        report(f"no symbol, {name}", lambda: try_decode(decode_from_image, frame), 3)
+
+
+def build_empty_frames(seed=0):
+    # a blurred 1080p frame of colored texture and a square of uniform noise, neither holds a symbol
+    rng = np.random.default_rng(seed)
+    texture = Image.fromarray(rng.integers(0, 256, (270, 480, 3), dtype=np.uint8)).resize((1920, 1080), Image.Resampling.BICUBIC)
+    noise = Image.fromarray(rng.integers(0, 256, (1000, 1000, 3), dtype=np.uint8))
+    return (("blurred 1920x1080", blur(texture, rng, radius=3.0)), ("noise 1000x1000", noise))
+
+
+def try_decode(decode, image):
+    try:
+        return decode(image)
+    except (ValueError, ReedSolomonError):
+        return None
+
+
+def bench_stacked(rows=(1, 2, 4, 5, 10), size=250, width=10, ecc=40, trials=20, noise_level=0.02, dpi=300, seed=0):
+    # the same full symbol in one row and stacked: area, render and read time per payload byte,
+    # and how many noisy scans still decode
+    print(f"stacked rows, array {size}, bar width {width} =")
+    rng = np.random.default_rng(seed)
+    payload = bytes(rng.integers(32, 127, size - 4 - ecc, dtype=np.uint8))
+    symbol = build_symbol(payload, size, ecc, compress=False)
+    pixels_per_cm2 = (dpi / 2.54) ** 2
+    for count in rows:
+        image = get_array_image(symbol, width, barHeight, rows=count)
+        scans = [simulate_image_noise(image, noise_level, seed=rng) for _ in range(trials)]
+        render = report(f"{count:2d} rows render", lambda: get_array_image(symbol, width, barHeight, rows=count), 20)
+        read = report(f"{count:2d} rows read", lambda: read_and_decode(image), 20)
+        decoded = sum(try_decode(decode_from_image, scan) == payload for scan in scans)
+        area = image.width * image.height
+        print(f"{'':<40} {image.width}x{image.height} px, {len(payload) / area * 1000:.2f} bytes/kpx, "
+              f"{len(payload) / area * pixels_per_cm2:.0f} bytes/cm2 at {dpi} dpi")
+        print(f"{'':<40} {render / len(payload) * 1e6:.2f} us render, {read / len(payload) * 1e6:.2f} us read per byte, "
+              f"{decoded}/{trials} noisy scans decoded")
+
+
+def bench_structured(size=5926, noise_levels=(0.0, 0.01), seed=0):
+    # a multi-symbol text payload, rendered and read back in shuffled order; every symbol has to
+    # decode for the payload to come back, so one unreadable chunk fails the whole round trip
+    print(f"structured append, {size} bytes ========")
+    rng = np.random.default_rng(seed)
+    words = ['alpha', 'beta', 'gamma', 'delta', 'record', 'field', 'value', 'id', '42', 'x']
+    payload = ' '.join(rng.choice(words, size)).encode('latin-1')[:size]
+    report("encode_structured", lambda: encode_structured(payload), 1)
+    images = [get_array_image(symbol, barWidth, barHeight) for symbol in encode_structured(payload)]
+    for noise_level in noise_levels:
+        scans = [simulate_image_noise(image, noise_level, seed=rng) if noise_level else image for image in images]
+        order = rng.permutation(len(scans))
+        recovered = []
+        report(f"{len(scans)} symbols, noise {noise_level}",
+               lambda: recovered.append(read_structured([scans[i] for i in order])), 1)
+        unread = sum(try_decode(decode_from_image, scan) is None for scan in scans)
+        print(f"{'':<40} {unread} unreadable symbols, payload {'ok' if recovered[-1] == payload else 'lost'}")
+
+
+def read_structured(scans):
+    reassembler = Reassembler()
+    for scan in scans:
+        message = try_decode(decode_from_image, scan)
+        if message is None:
+            continue
+        data = reassembler.add(bytes(message))
+        if data is not None:
+            return data
+    return None
+
+
+def bench_noise(levels=(0.01, 0.1), number=5):
+    print("simulate_image_noise ==================")
+    image = build_image()
+    for noise_level in levels:
+        legacy = report(f"legacy loop, noise {noise_level}", lambda: legacy_simulate_image_noise(image, noise_level), number)
+        fast = report(f"numpy stages, noise {noise_level}", lambda: simulate_image_noise(image, noise_level, seed=0), number)
+        print(f"speedup: {legacy / fast:.1f}x")
+
+
+def available_backends():
+    # import every backend that is installed, skipping the missing ones
+    modules = {}
+    for name in RS_BACKENDS:
+        try:
+            modules[name] = load_rs_backend(name)[1]
+        except ImportError:
+            print(f"backend {name} not installed, skipped")
+    return modules
+
+
+def compare_backends(levels=(10, 80, 200), trials=20, seed=0):
+    # every installed backend must produce the same codewords and repairs
+    modules = available_backends()
+    rng = random.Random(seed)
+    for ecc in levels:
+        codecs = {name: module.RSCodec(ecc) for name, module in modules.items()}
+        for _ in range(trials):
+            data = bytearray(rng.randrange(256) for _ in range(rng.randint(1, 255 - ecc)))
+            codewords = {name: bytearray(rsc.encode(data)) for name, rsc in codecs.items()}
+            reference = codewords[RS_BACKENDS[-1]]
+            assert all(codeword == reference for codeword in codewords.values()), f"codeword mismatch at ecc {ecc}"
+            # corrupt up to half the ecc budget and check every backend repairs it
+            damaged = bytearray(reference)
+            for pos in rng.sample(range(len(damaged)), ecc // 2):
+                damaged[pos] ^= rng.randrange(1, 256)
+            for name, rsc in codecs.items():
+                assert bytearray(rsc.decode(damaged)[0]) == data, f"{name} failed to repair at ecc {ecc}"
+    print(f"backends agree: {', '.join(modules)}")
+
+
+def bench_backends(levels=(10, 80, 200), count=20):
+    print("reed-solomon backends =================")
+    for name, module in available_backends().items():
+        for ecc in levels:
+            rsc = module.RSCodec(ecc)
+            data = bytearray(input_string.encode('latin-1'))
+            codeword = bytearray(rsc.encode(data))
+            codeword[0] ^= 0xFF
+            report(f"{name} ecc {ecc:3d} encode x{count}", lambda: [rsc.encode(data) for _ in range(count)], 1)
+            report(f"{name} ecc {ecc:3d} decode x{count}", lambda: [rsc.decode(codeword) for _ in range(count)], 1)
+
+
+if __name__ == "__main__":
+    bench_sampler()
+    bench_classify()
+    bench_renderer()
+    bench_orientation()
+    bench_scanner()
+    bench_stream(noise_level=0.0, sigma=0.0)
+    bench_stream()
+    bench_scene()
+    bench_skew()
+    bench_stacked()
+    bench_structured()
+    bench_noise()
+    compare_backends()
+    bench_codec()
+    bench_syndrome()
+    bench_backends()
@@ -0,0 +1,107 @@
+import zlib
+
+from instrument import stage
+
+# a compressed message starts with 0x00 then the codec id: a data bar for 0x00 is white,
+# so no text payload starts with it, and the flag sits inside the reed-solomon protected bytes
+COMPRESSED_MARKER = 0x00
+CODEC_DEFLATE = 1
+CODEC_DEFLATE_DICT = 2
+FLAG_SIZE = 2
+
+# preset deflate dictionary for short labels, most frequent strings last so they get the shortest distances
+STATIC_DICTIONARY = (
+    b"0123456789 ABCDEFGHIJKLMNOPQRSTUVWXYZ abcdefghijklmnopqrstuvwxyz "
+    b"order serial batch product customer number date name item price total quantity "
+    b"mailto: tel: .html .php .pdf /index ?id= &id= .org .net .com https://www. http://www. "
+    b"that this with from have which were there will would about your they their "
+    b"The the of the in the to the and the, . "
+)
+# raw deflate streams, the flag already says what follows so the zlib header and checksum are dead weight
+WBITS = -15
+
+
+def compress_deflate(data):
+    compressor = zlib.compressobj(9, zlib.DEFLATED, WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def compress_deflate_dict(data):
+    compressor = zlib.compressobj(9, zlib.DEFLATED, WBITS, zdict=STATIC_DICTIONARY)
+    return compressor.compress(data) + compressor.flush()
+
+
+def decompress_deflate(data):
+    return zlib.decompressobj(WBITS).decompress(data)
+
+
+def decompress_deflate_dict(data):
+    return zlib.decompressobj(WBITS, zdict=STATIC_DICTIONARY).decompress(data)
+
+
+# codec id -> (compress, decompress)
+CODECS = {
+    CODEC_DEFLATE: (compress_deflate, decompress_deflate),
+    CODEC_DEFLATE_DICT: (compress_deflate_dict, decompress_deflate_dict),
+}
+
+
+def to_bar_bytes(data):
+    # rewrite arbitrary bytes as base 254 digits 1..254, the bars cannot carry 0x00 / 0xff
+    # and 0x00 0x00 ends the codeword; the leading 1 keeps leading zero bytes
+    number = int.from_bytes(b'\x01' + data, 'big')
+    digits = bytearray()
+    while number:
+        number, digit = divmod(number, 254)
+        digits.append(digit + 1)
+    digits.reverse()
+    return bytes(digits)
+
+
+def from_bar_bytes(digits):
+    number = 0
+    for digit in digits:
+        if not 1 <= digit <= 254:
+            raise ValueError("Corrupted compressed payload")
+        number = number * 254 + digit - 1
+    data = number.to_bytes((number.bit_length() + 7) // 8, 'big')
+    if not data.startswith(b'\x01'):
+        raise ValueError("Corrupted compressed payload")
+    return data[1:]
+
+
+@stage('compress')
+def compress_payload(data, capacity=None):
+    # flagged compressed message, or the raw data when that is smaller
+    data = bytes(data)
+    best = None
+    for codec, (compress, _) in CODECS.items():
+        message = bytes((COMPRESSED_MARKER, codec)) + to_bar_bytes(compress(data))
+        if best is None or len(message) < len(best):
+            best = message
+    # a single 0x00 pad byte after the ecc bytes is not cut off by get_data_from_array and comes back as
+    # one extra message byte, a leading zero digit fills the symbol instead without changing the number
+    if capacity is not None and len(best) == capacity - 1:
+        best = best[:FLAG_SIZE] + b'\x01' + best[FLAG_SIZE:]
+    # raw data starting with the marker would read back as compressed, so it always takes the flag
+    if data[:1] == bytes((COMPRESSED_MARKER,)):
+        return best
+    # a truncated compressed message cannot be undone, past capacity keep raw data and its truncation warning
+    if len(best) < len(data) and (capacity is None or len(best) <= capacity):
+        return best
+    return data
+
+
+@stage('decompress')
+def decompress_payload(message):
+    # undo compress_payload, raw messages come back unchanged
+    message = bytes(message)
+    if message[:1] != bytes((COMPRESSED_MARKER,)):
+        return message
+    if len(message) < FLAG_SIZE or message[1] not in CODECS:
+        raise ValueError("Unknown payload compression flag")
+    _, decompress = CODECS[message[1]]
+    try:
+        return decompress(from_bar_bytes(message[FLAG_SIZE:]))
+    except zlib.error:
+        raise ValueError("Corrupted compressed payload")
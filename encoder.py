@@ -1,10 +1,113 @@
-from reedsolo import RSCodec  # type: ignore
+import importlib
+import os
+from functools import lru_cache
+from typing import Iterable, List, Tuple
 
+import numpy as np
 
+from instrument import stage
 
-def encode_data(data: bytes, array_size: int, error_correction_level: int) -> bytearray:
-    # create codec with given ecc level
-    rsc = RSCodec(error_correction_level)
+# reed-solomon implementations, fastest first; creedsolo is the cython build shipped with reedsolo
+RS_BACKENDS = ('creedsolo', 'reedsolo')
+# set to one of RS_BACKENDS to force a backend instead of picking the fastest installed one
+RS_BACKEND_ENV = 'QRCODE_RS_BACKEND'
+# number of distinct ecc levels kept as ready codecs
+CODEC_CACHE_SIZE = 16
+# bars read with a confidence below this are handed to reed-solomon as erasures
+ERASURE_THRESHOLD = 0.5
+# codewords that skipped the full decode, needed it, or could not be repaired, in this process
+DECODE_STATS = {'clean': 0, 'corrected': 0, 'failed': 0}
+
+
+def load_rs_backend(requested=None):
+    requested = (requested or os.environ.get(RS_BACKEND_ENV, '')).strip().lower()
+    if requested and requested not in RS_BACKENDS:
+        raise ValueError(f"Unknown Reed-Solomon backend {requested!r}, expected one of {', '.join(RS_BACKENDS)}.")
+    # a forced backend must import, otherwise fall back to the next one
+    for name in ((requested,) if requested else RS_BACKENDS):
+        try:
+            return name, importlib.import_module(name)
+        except ImportError:
+            if requested:
+                raise
+    raise ImportError("No Reed-Solomon backend available, install reedsolo.")
+
+
+RS_BACKEND, rs_module = load_rs_backend()
+RSCodec = rs_module.RSCodec
+# errors raised by the active backend, creedsolo has its own class
+ReedSolomonError = rs_module.ReedSolomonError
+
+
+@lru_cache(maxsize=CODEC_CACHE_SIZE)
+def get_codec(error_correction_level: int) -> RSCodec:
+    # codecs only hold their generator polynomial and gf tables, so one instance per nsym can be shared
+    return RSCodec(error_correction_level)
+
+
+def codec_cache_info():
+    # hits, misses, maxsize and currsize of the codec registry
+    return get_codec.cache_info()
+
+
+def decode_stats():
+    # snapshot of the clean / corrected / failed read counters
+    return dict(DECODE_STATS)
+
+
+def reset_decode_stats():
+    for key in DECODE_STATS:
+        DECODE_STATS[key] = 0
+
+
+def gf_mul(x, y, prim):
+    # carry-less multiply reduced by the primitive polynomial, only used to build the tables
+    result = 0
+    while y:
+        if y & 1:
+            result ^= x
+        y >>= 1
+        x <<= 1
+        if x & 0x100:
+            x ^= prim
+    return result
+
+
+@lru_cache(maxsize=None)
+def gf_tables(prim, generator):
+    # exp and log tables of GF(2^8) for the codec's primitive polynomial and generator
+    exp = np.zeros(255, dtype=np.uint8)
+    log = np.zeros(256, dtype=np.int64)
+    x = 1
+    for i in range(255):
+        exp[i] = x
+        log[x] = i
+        x = gf_mul(x, generator, prim)
+    return exp, log
+
+
+@lru_cache(maxsize=64)
+def syndrome_exponents(nsym, fcr, length):
+    # log of generator^((j + fcr) * (length - 1 - i)) for syndrome j and codeword byte i
+    j = np.arange(fcr, fcr + nsym)[:, np.newaxis]
+    i = np.arange(length - 1, -1, -1)[np.newaxis, :]
+    return (j * i) % 255
+
+
+def has_zero_syndromes(rsc: RSCodec, codeword) -> bool:
+    # evaluate the codeword at every root of the generator polynomial at once, all zero means no errors;
+    # codewords the codec would split into chunks take the full decode
+    length = len(codeword)
+    if not rsc.nsym < length <= rsc.nsize:
+        return False
+    exp, log = gf_tables(rsc.prim, rsc.generator)
+    c = np.frombuffer(bytes(codeword), dtype=np.uint8)
+    nonzero = np.flatnonzero(c)
+    powers = syndrome_exponents(rsc.nsym, rsc.fcr, length)[:, nonzero] + log[c[nonzero]]
+    return not np.bitwise_xor.reduce(exp[powers % 255], axis=1).any()
+
+
+def encode_with_codec(rsc: RSCodec, data: bytes, array_size: int) -> bytearray:
     # number of ecc bytes produced
     actual_nsym = rsc.nsym
     capacity = array_size - 4
@@ -15,7 +118,7 @@ def encode_data(data: bytes, array_size: int, error_correction_level: int) -> by
     # ensure there is space for at least one byte of data
     if max_payload <= 0:
         raise ValueError(
-            f"Byte array too small ({array_size}) for ECC level {error_correction_level} "
+            f"Byte array too small ({array_size}) for ECC level {actual_nsym} "
             f"(requires at least {actual_nsym + 1 + 4} total size)."
         )
 
@@ -32,16 +135,82 @@ def encode_data(data: bytes, array_size: int, error_correction_level: int) -> by
         encoded += bytearray(array_size - 4  - len(encoded))
 
     return encoded
-    
-    
 
-# decode codeword bytes using reed solomon
-def decode_data(codeword, error_correction_level):
-    # create codec with same ecc level
-    rsc = RSCodec(error_correction_level)
-    # decode codeword and extract message
-    msg = rsc.decode(codeword)
 
+@stage('encode')
+def encode_data(data: bytes, array_size: int, error_correction_level: int) -> bytearray:
+    # reuse the shared codec for this ecc level
+    return encode_with_codec(get_codec(error_correction_level), data, array_size)
+
+
+def encode_many(payloads: Iterable[bytes], array_size: int, error_correction_level: int) -> List[bytearray]:
+    # run every payload through the same codec
+    rsc = get_codec(error_correction_level)
+    return [encode_with_codec(rsc, data, array_size) for data in payloads]
+
+
+def repair_with_codec(rsc: RSCodec, codeword, erase_pos=None) -> Tuple[bytearray, int, str]:
+    # message, corrected byte count and 'clean' or 'corrected', the counters are left to the caller;
+    # most scans are clean, then the message is the codeword minus its ecc bytes and one syndrome pass is enough;
+    # without ecc bytes there is nothing to check, and the codec would cut long codewords to nothing
+    if rsc.nsym == 0 or has_zero_syndromes(rsc, codeword):
+        return bytearray(codeword[:len(codeword) - rsc.nsym]), 0, 'clean'
+
+    # decode codeword and extract message, along with how many bytes were corrected
+    msg = rsc.decode(codeword, erase_pos=erase_pos) if erase_pos else rsc.decode(codeword)
+    corrected = 0
     if isinstance(msg, tuple):
+        corrected = len(msg[2]) if len(msg) > 2 else 0
         msg = msg[0]
-    return bytearray(msg)
+    return bytearray(msg), corrected, 'corrected'
+
+
+def correct_with_codec(rsc: RSCodec, codeword, erase_pos=None) -> Tuple[bytearray, int]:
+    # one read, counted once as clean, corrected or failed
+    try:
+        message, corrected, outcome = repair_with_codec(rsc, codeword, erase_pos)
+    except ReedSolomonError:
+        DECODE_STATS['failed'] += 1
+        raise
+    DECODE_STATS[outcome] += 1
+    return message, corrected
+
+
+def decode_with_codec(rsc: RSCodec, codeword) -> bytearray:
+    return correct_with_codec(rsc, codeword)[0]
+
+
+# decode codeword bytes using reed solomon
+@stage('decode')
+def decode_data(codeword, error_correction_level, erase_pos=None):
+    # reuse the shared codec for this ecc level
+    return correct_with_codec(get_codec(error_correction_level), codeword, erase_pos)[0]
+
+
+def pick_erasures(confidence, error_correction_level, threshold=ERASURE_THRESHOLD) -> List[int]:
+    # least confident positions below the threshold, capped at half the ecc budget so unknown errors still get fixed
+    low = sorted((c, i) for i, c in enumerate(confidence) if c < threshold)
+    return sorted(i for _, i in low[:error_correction_level // 2])
+
+
+@stage('decode')
+def decode_data_with_confidence(codeword, error_correction_level, confidence,
+                                threshold=ERASURE_THRESHOLD) -> Tuple[bytearray, int]:
+    # erasures cost half as much ecc as unknown errors, so try with the doubtful bars erased first
+    rsc = get_codec(error_correction_level)
+    erase_pos = pick_erasures(confidence, error_correction_level, threshold)
+    if erase_pos:
+        try:
+            message, corrected, outcome = repair_with_codec(rsc, codeword, erase_pos)
+            DECODE_STATS[outcome] += 1
+            return message, corrected
+        except ReedSolomonError:
+            # a confident bar was wrong after all, fall back to plain error correction, still one read
+            pass
+    return correct_with_codec(rsc, codeword)
+
+
+def decode_many(codewords, error_correction_level) -> List[bytearray]:
+    # run every codeword through the same codec, a failing codeword raises like decode_data
+    rsc = get_codec(error_correction_level)
+    return [decode_with_codec(rsc, codeword) for codeword in codewords]
@@ -0,0 +1,178 @@
+import bisect
+import json
+import os
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+from functools import wraps
+
+# upper bounds in seconds of the stage latency histogram, same spacing as the prometheus client defaults
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+METRIC_PREFIX = 'barcode_stage'
+
+# every record goes to each of these, nothing is measured while the list is empty
+SINKS = []
+
+
+def enable(*sinks, trace_memory=False):
+    # add sinks, with trace_memory the bytes allocated during each stage are recorded as well (slow)
+    SINKS.extend(sinks)
+    if trace_memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+def disable():
+    # drop every sink, flushing the ones that write files, and stop tracemalloc
+    for sink in SINKS:
+        sink.close()
+    SINKS.clear()
+    if tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+
+def emit(record):
+    for sink in SINKS:
+        sink.record(record)
+
+
+@contextmanager
+def measure(name):
+    # time the block and report its outcome, the exception type name when it raises
+    tracing = tracemalloc.is_tracing()
+    if tracing:
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+    outcome = 'ok'
+    start = time.perf_counter()
+    try:
+        yield
+    except BaseException as e:
+        outcome = type(e).__name__
+        raise
+    finally:
+        record = {'stage': name, 'seconds': time.perf_counter() - start, 'outcome': outcome}
+        if tracing:
+            # peak above the starting point, so temporaries freed before the stage ends still count
+            record['allocated'] = tracemalloc.get_traced_memory()[1] - before
+        emit(record)
+
+
+def stage(name):
+    # decorator: record every call of the function as one stage, a single list check when disabled
+    def decorate(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not SINKS:
+                return func(*args, **kwargs)
+            with measure(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+class HistogramSink:
+    # in-memory latency histogram, outcome counts and allocated bytes per stage
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = tuple(buckets)
+        self.stages = {}
+
+    def record(self, record):
+        stats = self.stages.setdefault(record['stage'], {
+            'count': 0, 'seconds': 0.0, 'allocated': 0,
+            'buckets': [0] * (len(self.buckets) + 1), 'outcomes': {},
+        })
+        stats['count'] += 1
+        stats['seconds'] += record['seconds']
+        stats['allocated'] += record.get('allocated', 0)
+        stats['buckets'][bisect.bisect_left(self.buckets, record['seconds'])] += 1
+        stats['outcomes'][record['outcome']] = stats['outcomes'].get(record['outcome'], 0) + 1
+
+    def quantile(self, name, q):
+        # upper bound of the bucket holding the q-th quantile, inf past the last bucket
+        stats = self.stages[name]
+        rank = q * stats['count']
+        seen = 0
+        for bound, count in zip(self.buckets + (float('inf'),), stats['buckets']):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+    def summary(self):
+        lines = []
+        for name, stats in self.stages.items():
+            outcomes = ', '.join(f"{outcome} {count}" for outcome, count in stats['outcomes'].items())
+            line = (f"{name:<12} {stats['count']:6d} calls {stats['seconds'] / stats['count'] * 1000:10.3f} ms mean "
+                    f"p95 <= {self.quantile(name, 0.95) * 1000:g} ms ({outcomes})")
+            if stats['allocated']:
+                line += f", {stats['allocated'] / stats['count'] / 1024:.1f} KiB/call"
+            lines.append(line)
+        return '\n'.join(lines)
+
+    def close(self):
+        pass
+
+
+class JsonlSink:
+    # one JSON object per record, to a file path or an open text stream
+
+    def __init__(self, target=sys.stderr):
+        self.owned = isinstance(target, (str, os.PathLike))
+        self.stream = open(target, 'a') if self.owned else target
+
+    def record(self, record):
+        self.stream.write(json.dumps(record) + '\n')
+
+    def close(self):
+        if self.owned:
+            self.stream.close()
+        else:
+            self.stream.flush()
+
+
+class PrometheusSink(HistogramSink):
+    # histogram rewritten as a prometheus text exposition file, e.g. for the node exporter textfile collector
+
+    def __init__(self, path, buckets=BUCKETS):
+        super().__init__(buckets)
+        self.path = path
+
+    def render(self):
+        lines = [
+            f"# HELP {METRIC_PREFIX}_seconds Wall time per pipeline stage.",
+            f"# TYPE {METRIC_PREFIX}_seconds histogram",
+        ]
+        for name, stats in self.stages.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), stats['buckets']):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(f'{METRIC_PREFIX}_seconds_bucket{{stage="{name}",le="{le}"}} {cumulative}')
+            lines.append(f'{METRIC_PREFIX}_seconds_sum{{stage="{name}"}} {stats["seconds"]!r}')
+            lines.append(f'{METRIC_PREFIX}_seconds_count{{stage="{name}"}} {stats["count"]}')
+        lines += [
+            f"# HELP {METRIC_PREFIX}_outcomes_total Finished stage calls by outcome.",
+            f"# TYPE {METRIC_PREFIX}_outcomes_total counter",
+        ]
+        for name, stats in self.stages.items():
+            for outcome, count in stats['outcomes'].items():
+                lines.append(f'{METRIC_PREFIX}_outcomes_total{{stage="{name}",outcome="{outcome}"}} {count}')
+        lines += [
+            f"# HELP {METRIC_PREFIX}_allocated_bytes_total Bytes allocated per stage while tracemalloc is on.",
+            f"# TYPE {METRIC_PREFIX}_allocated_bytes_total counter",
+        ]
+        for name, stats in self.stages.items():
+            lines.append(f'{METRIC_PREFIX}_allocated_bytes_total{{stage="{name}"}} {stats["allocated"]}')
+        return '\n'.join(lines) + '\n'
+
+    def flush(self):
+        # write then rename, a scraper never sees a half written file
+        tmp = f"{self.path}.tmp"
+        with open(tmp, 'w') as f:
+            f.write(self.render())
+        os.replace(tmp, self.path)
+
+    def close(self):
+        self.flush()
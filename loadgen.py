@@ -0,0 +1,136 @@
+import argparse
+import asyncio
+import glob
+import io
+import json
+import os
+import time
+
+import numpy as np
+
+from barcode_drawer import simulate_image_noise
+from batch import IMAGE_EXTENSIONS
+from pipeline import encode_to_image
+from service import (request, serve, DEFAULT_HOST, DEFAULT_PORT, DEFAULT_QUEUE_SIZE, DEFAULT_BATCH_SIZE,
+                     DEFAULT_BATCH_DELAY, DEFAULT_TIMEOUT)
+
+
+def synthetic_labels(count=16, noise_level=0.02, seed=0):
+    # (payload, PNG bytes) pairs rendered like real labels, so the load needs no image files
+    rng = np.random.default_rng(seed)
+    labels = []
+    for index in range(count):
+        payload = f"label {index:05d} " + ''.join(chr(c) for c in rng.integers(97, 123, 40))
+        image = simulate_image_noise(encode_to_image(payload), noise_level, seed=rng)
+        buffer = io.BytesIO()
+        image.save(buffer, format='PNG')
+        labels.append((payload, buffer.getvalue()))
+    return labels
+
+
+def file_labels(directory):
+    # (None, file bytes) for every image in a directory, nothing to check the payload against
+    labels = []
+    for path in sorted(glob.glob(os.path.join(directory, '*'))):
+        if path.lower().endswith(IMAGE_EXTENSIONS):
+            with open(path, 'rb') as f:
+                labels.append((None, f.read()))
+    return labels
+
+
+async def client(host, port, labels, jobs, latencies, outcomes):
+    # one connection sending requests back to back until the shared job counter runs out
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        while jobs:
+            index = jobs.pop()
+            payload, blob = labels[index % len(labels)]
+            start = time.perf_counter()
+            result = await request(reader, writer, blob)
+            latencies.append(time.perf_counter() - start)
+            if not result['ok']:
+                outcome = result['error'].split(':')[0]
+            elif payload is not None and result['payload'] != payload:
+                outcome = 'wrong payload'
+            else:
+                outcome = 'ok'
+            outcomes[outcome] = outcomes.get(outcome, 0) + 1
+    finally:
+        writer.close()
+
+
+async def run_load(host, port, labels, requests=500, concurrency=16):
+    jobs = list(range(requests))
+    latencies = []
+    outcomes = {}
+    start = time.perf_counter()
+    await asyncio.gather(*(client(host, port, labels, jobs, latencies, outcomes) for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+
+    reader, writer = await asyncio.open_connection(host, port)
+    server_metrics = await request(reader, writer)
+    writer.close()
+
+    samples = np.array(latencies) * 1000
+    return {
+        'requests': requests,
+        'concurrency': concurrency,
+        'elapsed_s': round(elapsed, 3),
+        'throughput_rps': round(requests / elapsed, 2),
+        'latency_ms': {name: round(float(np.percentile(samples, q)), 3)
+                       for name, q in (('p50', 50), ('p95', 95), ('p99', 99), ('max', 100))},
+        'outcomes': outcomes,
+        'server': server_metrics,
+    }
+
+
+async def spawn_and_run(args, labels):
+    # run the service in this process for a self-contained measurement
+    server = asyncio.create_task(serve(args.host, args.port, workers=args.workers, batch_size=args.batch_size,
+                                       batch_delay=args.batch_delay, queue_size=args.queue_size, timeout=args.timeout))
+    for _ in range(100):
+        try:
+            _, writer = await asyncio.open_connection(args.host, args.port)
+            writer.close()
+            break
+        except OSError:
+            await asyncio.sleep(0.05)
+    try:
+        return await run_load(args.host, args.port, labels, args.requests, args.concurrency)
+    finally:
+        server.cancel()
+        try:
+            await server
+        except asyncio.CancelledError:
+            pass
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Concurrent load generator for the decode service.")
+    parser.add_argument('--host', default=DEFAULT_HOST)
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--requests', type=int, default=500)
+    parser.add_argument('--concurrency', type=int, default=16, help="open connections sending requests")
+    parser.add_argument('--images', help="directory of label images, synthetic labels by default")
+    parser.add_argument('--labels', type=int, default=16, help="distinct synthetic labels")
+    parser.add_argument('--noise-level', type=float, default=0.02)
+    parser.add_argument('--spawn', action='store_true', help="start the service in this process first")
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help="service workers with --spawn")
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE, help="service batch size with --spawn")
+    parser.add_argument('--batch-delay', type=float, default=DEFAULT_BATCH_DELAY, help="service batch delay with --spawn")
+    parser.add_argument('--queue-size', type=int, default=DEFAULT_QUEUE_SIZE, help="service queue size with --spawn")
+    parser.add_argument('--timeout', type=float, default=DEFAULT_TIMEOUT, help="service request timeout with --spawn")
+    args = parser.parse_args(argv)
+
+    labels = file_labels(args.images) if args.images else synthetic_labels(args.labels, args.noise_level)
+    if not labels:
+        parser.error(f"no images found in {args.images}")
+    if args.spawn:
+        report = asyncio.run(spawn_and_run(args, labels))
+    else:
+        report = asyncio.run(run_load(args.host, args.port, labels, args.requests, args.concurrency))
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,255 @@
+import argparse
+import json
+import math
+import sys
+from collections import namedtuple
+
+import numpy as np
+from PIL import Image
+
+from batch import chunked, run_pool
+from pipeline import to_image, decode_from_image
+from utils import is_dark
+
+# large scenes are searched on a copy whose longest side is at most this many pixels,
+# finder bars have to stay LOCATE_MIN_BAR pixels wide there, pass scale=1 for thin bars
+LOCATE_MAX_SIDE = 1200
+LOCATE_MIN_BAR = 2
+# scanlines a finder pattern has to show up on before it counts as a symbol
+LOCATE_MIN_ROWS = 3
+# finder bar widths within this ratio of each other count as one pitch
+PITCH_TOLERANCE = 2.0
+# share of the rows across the middle of a symbol that must be dark for a column to be its end bar
+END_BAR_DARK = 0.9
+
+# run classes on the searched copy
+LIGHT, DARK, COLORED = 0, 1, 2
+
+# a possible symbol: crop boxes (left, top, right, bottom) in the source image, most likely first,
+# one per reading direction that ends on an end bar, and the finder pitch in source pixels
+Candidate = namedtuple('Candidate', 'boxes pitch')
+
+
+def classify_pixels(pixels):
+    # dark, saturated and bright, or anything else, with the thresholds of find_finder_pattern
+    high = pixels.max(axis=-1).astype(np.int16)
+    low = pixels.min(axis=-1).astype(np.int16)
+    colored = (high > 127) & (2 * (high - low) > high)
+    return np.where(is_dark(pixels), DARK, np.where(colored, COLORED, LIGHT)).astype(np.int8)
+
+
+def pixel_runs(classes):
+    # (row, start, length, class) of every run of equal classes, row by row
+    h, w = classes.shape
+    starts = np.ones((h, w), dtype=bool)
+    starts[:, 1:] = classes[:, 1:] != classes[:, :-1]
+    rows, cols = np.nonzero(starts)
+    same_row = np.append(rows[1:] == rows[:-1], False)
+    ends = np.where(same_row, np.append(cols[1:], 0), w)
+    return rows, cols, ends - cols, classes[rows, cols]
+
+
+def finder_runs(classes):
+    # (row, first bar start, last bar end) of every black, colored, black run triple of similar widths
+    rows, cols, lengths, kinds = pixel_runs(classes)
+    if len(rows) < 3:
+        return np.empty((0, 3), dtype=int)
+    a, b, c = slice(0, -2), slice(1, -1), slice(2, None)
+    widths = np.stack((lengths[a], lengths[b], lengths[c]))
+    match = ((kinds[a] == DARK) & (kinds[b] == COLORED) & (kinds[c] == DARK)
+             & (rows[a] == rows[c])
+             & (widths.min(axis=0) >= LOCATE_MIN_BAR)
+             & (widths.max(axis=0) <= PITCH_TOLERANCE * widths.min(axis=0)))
+    index = np.flatnonzero(match)
+    return np.stack((rows[index], cols[index], cols[index + 2] + lengths[index + 2]), axis=1)
+
+
+def group_finders(runs):
+    # stack triples found at the same place on neighbouring rows, one group per finder pattern
+    groups = []
+    open_groups = []
+    for row, x0, x1 in runs:
+        # a sixth of the finder is half a bar, downsampling moves the edges by a pixel either way
+        tolerance = max(2, (x1 - x0) / 6)
+        for group in open_groups:
+            if row - group['rows'][-1] <= 2 and abs(group['x0'] - x0) <= tolerance \
+                    and abs(group['x1'] - x1) <= tolerance:
+                break
+        else:
+            group = {'rows': [], 'x0': x0, 'x1': x1, 'starts': [], 'ends': []}
+            groups.append(group)
+            open_groups.append(group)
+        if group['rows'] and group['rows'][-1] == row:
+            continue
+        group['rows'].append(row)
+        group['starts'].append(x0)
+        group['ends'].append(x1)
+        open_groups = [g for g in open_groups if row - g['rows'][-1] <= 2]
+    return groups
+
+
+def find_end_bar(dark_share, begin, step, pitch):
+    # (first, last) column of the first end bar walking from begin in the step direction, None when the line ends first
+    columns = np.arange(begin, len(dark_share)) if step > 0 else np.arange(begin, -1, -1)
+    hits = np.flatnonzero(dark_share[columns] >= END_BAR_DARK) if len(columns) else []
+    if not len(hits):
+        return None
+    run = columns[hits[0]:]
+    width = np.argmax(dark_share[run] < END_BAR_DARK) if (dark_share[run] < END_BAR_DARK).any() else len(run)
+    if width > PITCH_TOLERANCE * pitch + 1:
+        # a dark area, not a bar
+        return None
+    return int(min(run[0], run[width - 1])), int(max(run[0], run[width - 1]))
+
+
+def symbol_spans(group, classes):
+    # (start, end) along the scanlines for both reading directions of one finder pattern,
+    # most colored data strip first, ends include the end bar
+    top, bottom = group['rows'][0], group['rows'][-1] + 1
+    x0, x1 = int(np.median(group['starts'])), int(np.median(group['ends']))
+    pitch = (x1 - x0) / 3
+    height = bottom - top
+    if height < pitch:
+        return []
+    # end bars span the symbol height, look at the middle half of it
+    band = classes[top + height // 4:bottom - height // 4]
+    dark_share = (band == DARK).mean(axis=0)
+    colored_share = (band == COLORED).mean(axis=0)
+
+    spans = []
+    # the logo right after the finder is as wide as the symbol is tall, its dark parts are no end bar
+    forward = find_end_bar(dark_share, x1 + height, 1, pitch)
+    if forward is not None:
+        spans.append((colored_share[x1:forward[0]].mean(), (x0, forward[1] + 1)))
+    backward = find_end_bar(dark_share, x0 - height - 1, -1, pitch)
+    if backward is not None:
+        spans.append((colored_share[backward[1] + 1:x0].mean(), (backward[0], x1)))
+    spans.sort(key=lambda scored: -scored[0])
+    return [span for _, span in spans]
+
+
+def symbol_rows(pixels, x0, x1, top, bottom):
+    # exact rows of the symbol in the source image, from its finder: the reader takes the logo width
+    # from the crop height, so the crop has to end where the bars do
+    top = max(0, top)
+    strip = pixels[top:bottom, round(x0):round(x1)]
+    # two of the three finder bars are black, a little of the neighbouring bars may be in the strip too
+    rows = np.flatnonzero(is_dark(strip).mean(axis=1) >= 0.4)
+    if not len(rows):
+        return None
+    # the longest run of finder rows, noise can break it up
+    breaks = np.flatnonzero(np.diff(rows) > 1)
+    firsts = np.r_[0, breaks + 1]
+    lasts = np.r_[breaks, len(rows) - 1]
+    longest = np.argmax(rows[lasts] - rows[firsts])
+    return top + int(rows[firsts[longest]]), top + int(rows[lasts[longest]]) + 1
+
+
+def scene_scale(size, max_side=LOCATE_MAX_SIDE):
+    return max(1, math.ceil(max(size) / max_side))
+
+
+def locate_symbols(source, scale=None):
+    # finder patterns of every symbol in a photo or page scan, in reading order, as Candidate crops
+    image = to_image(source)
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    scale = scale or scene_scale(image.size)
+    small = image.reduce(scale) if scale > 1 else image
+    classes = classify_pixels(np.asarray(small))
+    pixels = np.asarray(image)
+
+    candidates = []
+    # rows find symbols read at 0 or 180 degrees, columns the ones at 90 or 270
+    for transposed, plane, full in ((False, classes, pixels), (True, classes.T, pixels.transpose(1, 0, 2))):
+        for group in group_finders(finder_runs(plane)):
+            if len(group['rows']) < LOCATE_MIN_ROWS:
+                continue
+            spans = symbol_spans(group, plane)
+            if not spans:
+                continue
+            x0, x1 = np.median(group['starts']) * scale, np.median(group['ends']) * scale
+            pitch = (x1 - x0) / 3
+            # the downsampled rows can miss a few source rows at either end
+            reach = round(2 * scale + pitch)
+            rows = symbol_rows(full, x0, x1, group['rows'][0] * scale - reach, (group['rows'][-1] + 1) * scale + reach)
+            if rows is None:
+                continue
+            # a little room along the scanlines, the reader looks for the first and last dark pixel
+            margin = max(1, round(pitch / 4))
+            boxes = []
+            for start, end in spans:
+                box = (max(0, start * scale - margin), rows[0], min(full.shape[1], end * scale + margin), rows[1])
+                box = tuple(int(value) for value in box)
+                boxes.append((box[1], box[0], box[3], box[2]) if transposed else box)
+            candidates.append((len(group['rows']), Candidate(boxes, float(pitch))))
+
+    # noise can split one finder into several groups, the one seen on the most rows stands for the symbol
+    kept = []
+    for _, candidate in sorted(candidates, key=lambda scored: -scored[0]):
+        if not any(overlap(candidate.boxes[0], other.boxes[0]) > 0.5 for other in kept):
+            kept.append(candidate)
+    kept.sort(key=lambda candidate: (candidate.boxes[0][1], candidate.boxes[0][0]))
+    return kept
+
+
+def overlap(a, b):
+    # intersection of two boxes over the smaller one
+    width = min(a[2], b[2]) - max(a[0], b[0])
+    height = min(a[3], b[3]) - max(a[1], b[1])
+    if width <= 0 or height <= 0:
+        return 0.0
+    return width * height / min((a[2] - a[0]) * (a[3] - a[1]), (b[2] - b[0]) * (b[3] - b[1]))
+
+
+def decode_candidates(crops):
+    # worker task: decode a chunk of candidates, each given as its crops in order of likelihood
+    results = []
+    for boxes, images in crops:
+        result = {'ok': False, 'box': list(boxes[0])}
+        for box, image in zip(boxes, images):
+            try:
+                payload = decode_from_image(image).decode('latin-1').rstrip('\x00')
+                result = {'ok': True, 'box': list(box), 'payload': payload}
+                break
+            except Exception as e:
+                # keep the first reading direction's error, it is the likely one
+                result.setdefault('error', f"{type(e).__name__}: {e}")
+        results.append(result)
+    return results
+
+
+def decode_scene(source, scale=None, workers=None, chunk_size=4):
+    # locate and decode every symbol in one image, on a process pool when there are several;
+    # one result dict per candidate, failed ones included, in reading order
+    image = to_image(source)
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    crops = [(candidate.boxes, [image.crop(box) for box in candidate.boxes])
+             for candidate in locate_symbols(image, scale)]
+    if len(crops) <= 1 or workers == 1:
+        return decode_candidates(crops)
+    results = []
+    for chunk in run_pool(decode_candidates, chunked(crops, chunk_size), workers):
+        results.extend(chunk)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Find and decode every barcode in photos or page scans.")
+    parser.add_argument('images', nargs='+')
+    parser.add_argument('--scale', type=int, default=None,
+                        help=f"search downsampling factor, by default the longest side is cut to {LOCATE_MAX_SIDE} px")
+    parser.add_argument('--workers', type=int, default=None)
+    args = parser.parse_args(argv)
+    for path in args.images:
+        with Image.open(path) as image:
+            image = image.convert('RGB')
+        results = decode_scene(image, args.scale, args.workers)
+        for result in results:
+            print(json.dumps({'file': path, **result}))
+        print(f"{path}: {sum(result['ok'] for result in results)} of {len(results)} symbols decoded", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,9 @@
 # import modules from barcode system
-from barcode_drawer import set_finder_pattern, get_array_image, save_image, load_image, simulate_image_noise
-from encoder import encode_data, decode_data
-from utils import format_image, get_array_from_image, get_data_from_array, compare_results
-from reedsolo import ReedSolomonError # type: ignore
+from barcode_drawer import save_image, simulate_image_noise
+from encoder import ReedSolomonError
+from instrument import enable, disable, HistogramSink
+from pipeline import encode_to_image, decode_from_image
+from utils import compare_results
 
 barHeight = 100
 arraySize = 150
@@ -55,47 +56,26 @@ def configure_test():
         print(f"Invalid input: {e}. Using default values.")
 
 def run_test():
+    # time every pipeline stage of this run, printed once it is over
+    timings = HistogramSink()
+    enable(timings)
     try:
-        # prepare raw byte array
-        byteArray = bytearray(arraySize)
         data_bytes = input_string.encode('latin-1')
 
-        payload_size = arraySize - 4
-        # fill payload with input data
-
         print("Original data (str):", input_string)
 
-        # insert finder pattern into array
-        set_finder_pattern(byteArray, error_correction_level)
-        # encode data with error correction
-        encoded = encode_data(data_bytes, arraySize, error_correction_level)
-        # prepare final array with finder pattern
-        encoded_with_finder = bytearray(arraySize)
-        encoded_with_finder[3:-1] = encoded
-
-        set_finder_pattern(encoded_with_finder, error_correction_level)
-
-        # generate barcode image from array
-        barcode_image = get_array_image(encoded_with_finder, barWidth, barHeight)
+        # encode data and render the barcode image in memory
+        barcode_image = encode_to_image(data_bytes, arraySize, barWidth, barHeight, error_correction_level)
         # apply noise to image for testing
         barcode_image = simulate_image_noise(barcode_image, noise_level)
 
-
+        # save for inspection, decoding below works on the in-memory image
         save_image(barcode_image, 'barcode.png')
 
         # ========================================== Now we simulate a test run where we read the image back =================================
 
-        loaded_image = load_image('barcode.png')
-
-        # detect and align barcode orientation
-        formatted_image = format_image(loaded_image, expected_width= arraySize * barWidth  + barHeight)
-        # convert image back to array
-        read_array = get_array_from_image(formatted_image, barWidth, barHeight)
-        # extract data and error correction level from array
-        data_chunk, ecc = get_data_from_array(read_array, barWidth)
-
-        # decode data with error correction
-        decoded = decode_data(data_chunk[:len(encoded)], ecc)
+        # sample and decode the barcode, dumping the scanlines it was read from for inspection
+        decoded = decode_from_image(barcode_image, debug_hook=lambda image: save_image(image, 'barcode_formatted.png'))
 
         decoded_str = decoded.decode('latin-1').rstrip('\x00')
         wrong = compare_results(input_string, decoded_str)
@@ -105,6 +85,10 @@ def run_test():
 
     except (ValueError, ReedSolomonError) as e:
         print("Error during test run:", e)
+    finally:
+        disable()
+        print("Stage timings ===========================")
+        print(timings.summary())
 
 if __name__ == "__main__":
     configure_test()
@@ -0,0 +1,94 @@
+import time
+
+import numpy as np
+from PIL import Image
+
+from barcode_drawer import set_finder_pattern, get_array_image, DEFAULT_LOGO_PATH
+from compression import compress_payload, decompress_payload
+from encoder import encode_data, decode_data_with_confidence, ReedSolomonError
+from utils import read_array_and_confidence, get_data_from_array, estimate_skew, has_finder_run
+
+# same defaults as the interactive test in main.py
+DEFAULT_ARRAY_SIZE = 150
+DEFAULT_BAR_WIDTH = 20
+DEFAULT_BAR_HEIGHT = 100
+DEFAULT_ECC_LEVEL = 80
+
+OUTPUT_FORMATS = ('image', 'array', 'bytes')
+
+
+def build_symbol(data, array_size=DEFAULT_ARRAY_SIZE, error_correction_level=DEFAULT_ECC_LEVEL, compress=True):
+    # encode data with error correction and wrap it in the finder pattern
+    if isinstance(data, str):
+        data = data.encode('latin-1')
+    if compress:
+        # compressed when that is smaller, decode_from_image undoes it from the flag
+        data = compress_payload(data, array_size - 4 - error_correction_level)
+    symbol = bytearray(array_size)
+    symbol[3:-1] = encode_data(bytes(data), array_size, error_correction_level)
+    set_finder_pattern(symbol, error_correction_level)
+    return symbol
+
+
+def to_image(source, size=None):
+    # accept a PIL image, an (h, w, 3) uint8 array or a raw RGB buffer of the given (width, height)
+    if isinstance(source, Image.Image):
+        return source
+    if isinstance(source, np.ndarray):
+        return Image.fromarray(np.ascontiguousarray(source, dtype=np.uint8))
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        if size is None:
+            raise ValueError("size=(width, height) is required to read a raw RGB buffer.")
+        # frombuffer wraps the caller's memory instead of copying it
+        return Image.frombuffer('RGB', size, source, 'raw', 'RGB', 0, 1)
+    raise TypeError(f"Unsupported image source: {type(source).__name__}")
+
+
+def from_image(image, output_format='image'):
+    # return the rendered barcode in the requested in-memory format
+    if output_format == 'image':
+        return image
+    if output_format == 'array':
+        return np.asarray(image)
+    if output_format == 'bytes':
+        return image.tobytes()
+    raise ValueError(f"Unknown output format {output_format!r}, expected one of {', '.join(OUTPUT_FORMATS)}.")
+
+
+def encode_to_image(data, array_size=DEFAULT_ARRAY_SIZE, barWidth=DEFAULT_BAR_WIDTH, barHeight=DEFAULT_BAR_HEIGHT,
+                    error_correction_level=DEFAULT_ECC_LEVEL, output_format='image', logo_path=DEFAULT_LOGO_PATH,
+                    compress=True, rows=1):
+    # rows > 1 stacks the bars in that many rows, decode_from_image tells the layouts apart by itself
+    symbol = build_symbol(data, array_size, error_correction_level, compress)
+    return from_image(get_array_image(symbol, barWidth, barHeight, logo_path, rows), output_format)
+
+
+def decode_from_image(source, size=None, debug_hook=None):
+    image = to_image(source, size)
+    return read_deskewed(image, lambda skew: read_and_decode(image, debug_hook, skew))[0]
+
+
+def read_deskewed(image, read, timings=None):
+    # (read(skew), skew): read(0.0) on axis-aligned scanlines first, and when that fails once more along the
+    # symbol's own axis; even a slight tilt is read again, the tilted scanlines stay inside the measured band.
+    # Frames with no finder-like run anywhere fail straight away, the skew search costs far more than the read.
+    # timings, when given, gets the time the skew estimate took
+    try:
+        return read(0.0), 0.0
+    except (ValueError, ReedSolomonError):
+        start = time.perf_counter()
+        skew = estimate_skew(image) if has_finder_run(image) else 0.0
+        if timings is not None:
+            timings['skew'] = time.perf_counter() - start
+        if not skew:
+            raise
+    return read(skew), skew
+
+
+def read_and_decode(image, debug_hook=None, skew=0.0):
+    # find the bars along a few scanlines of the source image, no resize and no known geometry needed
+    read_array, confidence = read_array_and_confidence(image, debug_hook=debug_hook, skew=skew)
+    data_chunk, ecc = get_data_from_array(read_array)
+    # doubtful bars go to reed-solomon as erasures
+    message = decode_data_with_confidence(data_chunk, ecc, confidence[3:3 + len(data_chunk)])[0]
+    return bytearray(decompress_payload(message))
@@ -0,0 +1,154 @@
+import argparse
+import os
+from collections import defaultdict
+from functools import lru_cache
+
+from sweep import sweep
+
+# success rate per (noise level, array size) and ecc level, measured with sweep.py at bar width 20,
+# bar height 100 and 100 trials per cell; rebuild with `python planner.py --measure`
+DECODE_CURVES = {
+    0.01: {
+        50: ((4, 1.0), (8, 1.0), (16, 1.0), (32, 1.0)),
+        100: ((4, 1.0), (8, 1.0), (16, 1.0), (32, 1.0), (48, 1.0), (64, 0.99)),
+        150: ((4, 1.0), (8, 1.0), (16, 1.0), (32, 1.0), (48, 0.99), (64, 1.0), (96, 0.99), (128, 1.0)),
+        200: ((4, 1.0), (8, 0.99), (16, 0.99), (32, 1.0), (48, 1.0), (64, 0.99), (96, 0.99), (128, 0.99)),
+        250: ((4, 1.0), (8, 1.0), (16, 1.0), (32, 0.99), (48, 0.98), (64, 1.0), (96, 0.99), (128, 0.98)),
+    },
+    0.05: {
+        50: ((4, 1.0), (8, 1.0), (16, 0.99), (32, 0.99)),
+        100: ((4, 1.0), (8, 0.99), (16, 1.0), (32, 1.0), (48, 1.0), (64, 1.0)),
+        150: ((4, 1.0), (8, 0.99), (16, 1.0), (32, 1.0), (48, 1.0), (64, 1.0), (96, 1.0), (128, 1.0)),
+        200: ((4, 0.99), (8, 0.99), (16, 1.0), (32, 1.0), (48, 0.99), (64, 0.98), (96, 0.99), (128, 0.99)),
+        250: ((4, 0.98), (8, 0.97), (16, 0.98), (32, 1.0), (48, 0.99), (64, 1.0), (96, 1.0), (128, 0.99)),
+    },
+    0.1: {
+        50: ((4, 1.0), (8, 0.98), (16, 0.97), (32, 0.97)),
+        100: ((4, 0.92), (8, 0.99), (16, 0.98), (32, 0.98), (48, 0.94), (64, 0.94)),
+        150: ((4, 0.83), (8, 0.97), (16, 0.97), (32, 0.97), (48, 0.98), (64, 0.99), (96, 0.94), (128, 0.97)),
+        200: ((4, 0.66), (8, 0.94), (16, 0.99), (32, 1.0), (48, 0.95), (64, 0.98), (96, 0.98), (128, 0.99)),
+        250: ((4, 0.59), (8, 0.91), (16, 0.99), (32, 0.98), (48, 0.96), (64, 0.95), (96, 0.94), (128, 0.95)),
+    },
+    0.2: {
+        50: ((4, 0.13), (8, 0.45), (16, 0.85), (32, 0.81)),
+        100: ((4, 0.0), (8, 0.04), (16, 0.37), (32, 0.83), (48, 0.83), (64, 0.77)),
+        150: ((4, 0.0), (8, 0.0), (16, 0.03), (32, 0.72), (48, 0.73), (64, 0.88), (96, 0.78), (128, 0.74)),
+        200: ((4, 0.0), (8, 0.0), (16, 0.0), (32, 0.13), (48, 0.7), (64, 0.78), (96, 0.83), (128, 0.81)),
+        250: ((4, 0.0), (8, 0.0), (16, 0.0), (32, 0.03), (48, 0.48), (64, 0.75), (96, 0.81), (128, 0.78)),
+    },
+}
+MEASURE_ARRAY_SIZES = (50, 100, 150, 200, 250)
+MEASURE_ECC_LEVELS = (4, 8, 16, 32, 48, 64, 96, 128)
+MEASURE_NOISE_LEVELS = (0.01, 0.05, 0.1, 0.2)
+# the measured success rates plateau just under 1.0 because of failed detections, not missing ecc
+DEFAULT_TARGET_SUCCESS = 0.95
+DEFAULT_NOISE_LEVEL = 0.05
+
+
+def required_ecc(curve, target_success):
+    # lowest measured ecc level that reaches the target, None when none does
+    for error_correction_level, success_rate in curve:
+        if success_rate >= target_success:
+            return error_correction_level
+    return None
+
+
+def curve_noise_level(noise_level):
+    # plan against the closest measured noise level at or above the requested one
+    for measured in sorted(DECODE_CURVES):
+        if measured >= noise_level:
+            return measured
+    raise ValueError(f"No decode curve measured for noise level {noise_level}, the highest is {max(DECODE_CURVES)}.")
+
+
+@lru_cache(maxsize=None)
+def plan_table(noise_level, target_success):
+    # payload length -> smallest (array_size, ecc level), from capacity = array_size - 4 - ecc over every array size;
+    # each size uses the curve of the next measured size up, bigger symbols at the same ecc read no better
+    curves = DECODE_CURVES[curve_noise_level(noise_level)]
+    measured_sizes = sorted(curves)
+    table = []
+    for array_size in range(6, measured_sizes[-1] + 1):
+        curve_size = next(size for size in measured_sizes if size >= array_size)
+        error_correction_level = required_ecc(curves[curve_size], target_success)
+        if error_correction_level is None:
+            continue
+        capacity = array_size - 4 - error_correction_level
+        while len(table) < capacity + 1:
+            table.append((array_size, error_correction_level))
+    return table
+
+
+def plan_symbol(payload_length, noise_level=DEFAULT_NOISE_LEVEL, target_success=DEFAULT_TARGET_SUCCESS):
+    # smallest array size and its ecc level that carry payload_length bytes at the target success rate
+    table = plan_table(curve_noise_level(noise_level), target_success)
+    if payload_length >= len(table):
+        if not table:
+            raise ValueError(f"No measured symbol reaches a {target_success:.0%} success rate at noise {noise_level}.")
+        raise ValueError(
+            f"Payload of {payload_length} bytes does not fit one symbol at a {target_success:.0%} success rate "
+            f"and noise {noise_level}, at most {len(table) - 1} bytes do; use structured append."
+        )
+    return table[payload_length]
+
+
+def plan_ecc(payload_length, array_size, noise_level=DEFAULT_NOISE_LEVEL, target_success=DEFAULT_TARGET_SUCCESS):
+    # ecc level for a fixed array size: the measured one for the target, or as much as still leaves room for the payload
+    spare = array_size - 4 - max(1, payload_length)
+    if spare < 0:
+        raise ValueError(f"Payload of {payload_length} bytes does not fit an array of size {array_size}.")
+    curves = DECODE_CURVES[curve_noise_level(noise_level)]
+    curve_size = next((size for size in sorted(curves) if size >= array_size), max(curves))
+    error_correction_level = required_ecc(curves[curve_size], target_success)
+    return spare if error_correction_level is None else min(error_correction_level, spare)
+
+
+def plan_array_size(payload_length, error_correction_level):
+    # smallest array size that carries the payload at a fixed ecc level, bigger symbols read no better
+    return max(1, payload_length) + 4 + error_correction_level
+
+
+def measure_curves(trials=100, workers=None, seed=0):
+    # rerun the sweep behind DECODE_CURVES
+    rows = sweep(MEASURE_ARRAY_SIZES, [20], MEASURE_ECC_LEVELS, MEASURE_NOISE_LEVELS, trials, seed=seed, workers=workers)
+    curves = defaultdict(lambda: defaultdict(list))
+    for row in rows:
+        curves[row['noise_level']][row['array_size']].append((row['error_correction_level'], row['success_rate']))
+    return curves
+
+
+def format_curves(curves):
+    lines = ["DECODE_CURVES = {"]
+    for noise_level in sorted(curves):
+        lines.append(f"    {noise_level}: {{")
+        for array_size in sorted(curves[noise_level]):
+            lines.append(f"        {array_size}: {tuple(curves[noise_level][array_size])},")
+        lines.append("    },")
+    lines.append("}")
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Pick the smallest symbol for a payload length.")
+    parser.add_argument('payload_length', type=int, nargs='?')
+    parser.add_argument('--noise-level', type=float, default=DEFAULT_NOISE_LEVEL)
+    parser.add_argument('--target-success', type=float, default=DEFAULT_TARGET_SUCCESS)
+    parser.add_argument('--measure', action='store_true', help="rerun the sweep and print a new DECODE_CURVES table")
+    parser.add_argument('--trials', type=int, default=100, help="trials per grid cell with --measure")
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    args = parser.parse_args(argv)
+
+    if args.measure:
+        print(format_curves(measure_curves(args.trials, args.workers)))
+        return
+    if args.payload_length is None:
+        parser.error("payload_length is required unless --measure is given")
+    try:
+        array_size, error_correction_level = plan_symbol(args.payload_length, args.noise_level, args.target_success)
+    except ValueError as e:
+        parser.error(str(e))
+    print(f"array size {array_size}, ecc level {error_correction_level}")
+
+
+if __name__ == "__main__":
+    main()
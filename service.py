@@ -0,0 +1,219 @@
+import argparse
+import asyncio
+import io
+import json
+import os
+import struct
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from batch import decode_stream
+
+# every message, both ways, is a 4-byte big-endian length followed by that many bytes:
+# image file bytes in, one JSON object out; an empty request asks for the metrics instead
+HEADER = struct.Struct('>I')
+MAX_REQUEST_SIZE = 32 * 1024 * 1024
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8765
+DEFAULT_QUEUE_SIZE = 256
+DEFAULT_BATCH_SIZE = 8
+# how long the first request of a batch waits for company, in seconds
+DEFAULT_BATCH_DELAY = 0.002
+DEFAULT_TIMEOUT = 10.0
+# latency percentiles are taken over this many most recent requests
+LATENCY_WINDOW = 10000
+
+
+def decode_blobs(blobs):
+    # worker task: decode a batch of encoded images
+    return [decode_stream(io.BytesIO(blob)) for blob in blobs]
+
+
+async def read_message(reader):
+    # None once the peer closed the connection between messages
+    try:
+        header = await reader.readexactly(HEADER.size)
+    except asyncio.IncompleteReadError as e:
+        if e.partial:
+            raise
+        return None
+    (length,) = HEADER.unpack(header)
+    if length > MAX_REQUEST_SIZE:
+        raise ValueError(f"Request of {length} bytes is over the {MAX_REQUEST_SIZE} byte limit")
+    return await reader.readexactly(length)
+
+
+async def write_message(writer, payload):
+    writer.write(HEADER.pack(len(payload)) + payload)
+    await writer.drain()
+
+
+async def request(reader, writer, data=b''):
+    # client side of one round trip, the decoded JSON result
+    await write_message(writer, data)
+    response = await read_message(reader)
+    if response is None:
+        raise ConnectionError("Server closed the connection")
+    return json.loads(response)
+
+
+class DecodeService:
+    # decodes image bytes on a process pool, with a bounded queue, batching and per-request timeouts
+
+    def __init__(self, workers=None, queue_size=DEFAULT_QUEUE_SIZE, batch_size=DEFAULT_BATCH_SIZE,
+                 batch_delay=DEFAULT_BATCH_DELAY, timeout=DEFAULT_TIMEOUT):
+        self.workers = workers or os.cpu_count() or 1
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self.timeout = timeout
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        # one batch per worker in flight, further requests wait in the queue where the bound applies
+        self.slots = asyncio.Semaphore(self.workers)
+        self.pool = None
+        self.batcher = None
+        self.started = time.monotonic()
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self.counts = {'requests': 0, 'ok': 0, 'failed': 0, 'rejected': 0, 'timeout': 0, 'batches': 0, 'batched': 0}
+
+    async def start(self):
+        self.pool = ProcessPoolExecutor(max_workers=self.workers)
+        self.batcher = asyncio.create_task(self.run_batches())
+
+    async def close(self):
+        self.batcher.cancel()
+        try:
+            await self.batcher
+        except asyncio.CancelledError:
+            pass
+        self.pool.shutdown(cancel_futures=True)
+
+    async def decode(self, blob):
+        # queue one image, the result dict once a worker decoded it
+        self.counts['requests'] += 1
+        start = time.perf_counter()
+        future = asyncio.get_running_loop().create_future()
+        try:
+            self.queue.put_nowait((blob, future))
+        except asyncio.QueueFull:
+            # shed load right away instead of letting every queued request time out
+            self.counts['rejected'] += 1
+            return self.finish(start, {'ok': False, 'error': "Overloaded: decode queue is full"})
+        try:
+            result = await asyncio.wait_for(future, self.timeout)
+        except asyncio.TimeoutError:
+            # wait_for cancelled the future, a batch still running for it drops the result
+            self.counts['timeout'] += 1
+            return self.finish(start, {'ok': False, 'error': f"Timed out after {self.timeout} s"})
+        self.counts['ok' if result['ok'] else 'failed'] += 1
+        return self.finish(start, result)
+
+    def finish(self, start, result):
+        self.latencies.append(time.perf_counter() - start)
+        return result
+
+    async def next_batch(self):
+        # the first waiting request, then whatever else arrives within batch_delay, up to batch_size
+        batch = [await self.queue.get()]
+        deadline = time.monotonic() + self.batch_delay
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        # requests that timed out while queued are not worth decoding
+        return [(blob, future) for blob, future in batch if not future.done()]
+
+    async def run_batches(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await self.slots.acquire()
+            batch = await self.next_batch()
+            if not batch:
+                self.slots.release()
+                continue
+            self.counts['batches'] += 1
+            self.counts['batched'] += len(batch)
+            work = loop.run_in_executor(self.pool, decode_blobs, [blob for blob, _ in batch])
+            work.add_done_callback(lambda work, batch=batch: self.resolve(batch, work))
+
+    def resolve(self, batch, work):
+        self.slots.release()
+        error = work.exception()
+        for index, (_, future) in enumerate(batch):
+            if future.done():
+                continue
+            if error is not None:
+                future.set_result({'ok': False, 'error': f"{type(error).__name__}: {error}"})
+            else:
+                future.set_result(work.result()[index])
+
+    def metrics(self):
+        elapsed = time.monotonic() - self.started
+        metrics = {**self.counts, 'queued': self.queue.qsize(), 'uptime_s': round(elapsed, 3),
+                   'throughput_rps': round(self.counts['requests'] / elapsed, 3) if elapsed else 0.0}
+        if self.counts['batches']:
+            metrics['mean_batch_size'] = round(self.counts['batched'] / self.counts['batches'], 3)
+        if self.latencies:
+            samples = np.array(self.latencies) * 1000
+            metrics['latency_ms'] = {name: round(float(np.percentile(samples, q)), 3)
+                                     for name, q in (('p50', 50), ('p95', 95), ('p99', 99), ('max', 100))}
+        return metrics
+
+    async def handle(self, reader, writer):
+        # one connection, requests are answered in order
+        try:
+            while True:
+                try:
+                    blob = await read_message(reader)
+                except (ValueError, asyncio.IncompleteReadError) as e:
+                    await write_message(writer, json.dumps({'ok': False, 'error': str(e)}).encode())
+                    break
+                if blob is None:
+                    break
+                result = self.metrics() if not blob else await self.decode(blob)
+                await write_message(writer, json.dumps(result).encode())
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+
+async def serve(host=DEFAULT_HOST, port=DEFAULT_PORT, **options):
+    service = DecodeService(**options)
+    await service.start()
+    server = await asyncio.start_server(service.handle, host, port)
+    print(f"decoding on {host}:{port} with {service.workers} workers", file=sys.stderr, flush=True)
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        await service.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Length-prefixed TCP decode service.")
+    parser.add_argument('--host', default=DEFAULT_HOST)
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--queue-size', type=int, default=DEFAULT_QUEUE_SIZE, help="queued requests before rejecting")
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE, help="images per worker task")
+    parser.add_argument('--batch-delay', type=float, default=DEFAULT_BATCH_DELAY,
+                        help="seconds a request waits for others to share its batch")
+    parser.add_argument('--timeout', type=float, default=DEFAULT_TIMEOUT, help="seconds per request")
+    args = parser.parse_args(argv)
+    try:
+        asyncio.run(serve(args.host, args.port, workers=args.workers, queue_size=args.queue_size,
+                          batch_size=args.batch_size, batch_delay=args.batch_delay, timeout=args.timeout))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
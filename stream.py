@@ -0,0 +1,116 @@
+import numpy as np
+
+from compression import decompress_payload
+from encoder import decode_data_with_confidence, get_codec, has_zero_syndromes, ReedSolomonError
+from pipeline import to_image, read_deskewed
+from utils import find_bar_grid, sample_bar_grid, sample_symbol, scan_lines, get_data_from_array, SCAN_LINES
+
+# scanlines sampled on the cached grid when the middle one alone does not pass the syndrome-only check:
+# their median is checked the same way, then gets full error correction before the full search
+STREAM_SCAN_LINES = SCAN_LINES
+# frames in a row without a read after which the last payload counts as new again
+FORGET_AFTER = 30
+
+
+class FrameDecoder:
+    # decodes consecutive frames, reusing the bar grid found in an earlier frame until it stops reading
+
+    def __init__(self, scan_line_count=STREAM_SCAN_LINES, forget_after=FORGET_AFTER):
+        self.scan_line_count = scan_line_count
+        self.forget_after = forget_after
+        self.grid = None
+        self.last_payload = None
+        self.missed = 0
+        self.stats = {'frames': 0, 'cached': 0, 'redetected': 0, 'failed': 0, 'duplicates': 0}
+
+    def read(self, image, lines, grid, line=None):
+        # payload on the given grid, the reed-solomon decode is what validates the grid
+        array, confidence = sample_symbol(image, grid, lines, line)
+        if array[0] != 0 or array[2] != 0:
+            raise ValueError("Finder pattern not on the bar grid")
+        data_chunk, ecc = get_data_from_array(array)
+        message = decode_data_with_confidence(data_chunk, ecc, confidence[3:3 + len(data_chunk)])[0]
+        return decompress_payload(message)
+
+    def read_clean(self, lines):
+        # steady state: the per-pixel median of the scanlines on the cached grid, accepted only when every
+        # syndrome is zero
+        array, _ = sample_bar_grid(lines, self.grid, with_confidence=False)
+        data_chunk, ecc = get_data_from_array(array)
+        rsc = get_codec(ecc)
+        if array[0] != 0 or array[2] != 0 or not has_zero_syndromes(rsc, data_chunk):
+            return None
+        return decompress_payload(data_chunk[:len(data_chunk) - rsc.nsym])
+
+    def search(self, image):
+        # (grid, payload) from a full search, along the symbol's own axis when it is skewed; with a grid cached
+        # for this frame size the axis is already known, a skew estimated on one noisy frame would only
+        # swap the grid for one a few hundredths of a degree off
+        if self.grid is not None and self.grid.size == image.size:
+            return self.search_at(image, self.grid.skew)
+        return read_deskewed(image, lambda skew: self.search_at(image, skew))[0]
+
+    def search_at(self, image, skew):
+        grid, lines, line = find_bar_grid(image, skew=skew)
+        return grid, self.read(image, lines, grid, line)
+
+    def decode_frame(self, frame):
+        # the payload when this frame reads and differs from the last one reported, otherwise None
+        image = to_image(frame)
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        self.stats['frames'] += 1
+
+        payload = None
+        if self.grid is not None and self.grid.size == image.size:
+            try:
+                # a clean frame reads on the middle scanline, a lightly noisy one on the median of a few
+                grid = self.grid
+                payload = self.read_clean(scan_lines(image, grid.rotation, 1, grid.skew, grid.band)[0])
+                if payload is None:
+                    lines, _ = scan_lines(image, grid.rotation, self.scan_line_count, grid.skew, grid.band)
+                    payload = self.read_clean(lines)
+                    if payload is None:
+                        payload = self.read(image, lines, grid)
+                self.stats['cached'] += 1
+            except (ValueError, ReedSolomonError):
+                payload = None
+        if payload is None:
+            # the symbol moved, changed or was never seen: full orientation search and grid fit
+            try:
+                grid, payload = self.search(image)
+            except (ValueError, ReedSolomonError):
+                self.stats['failed'] += 1
+                self.missed += 1
+                if self.missed >= self.forget_after:
+                    self.last_payload = None
+                if self.missed > 1:
+                    # two frames in a row without a read: the next one measures the skew again
+                    self.grid = None
+                return None
+            self.grid = snap_skew(grid)
+            self.stats['redetected'] += 1
+
+        self.missed = 0
+        if payload == self.last_payload:
+            self.stats['duplicates'] += 1
+            return None
+        self.last_payload = payload
+        return payload
+
+
+def snap_skew(grid):
+    # a tilt that moves the scanlines by less than a pixel over the whole symbol is read axis-aligned,
+    # so a fixed camera keeps one grid instead of one per skew estimate
+    if grid.skew and abs(np.tan(np.radians(grid.skew))) * grid.count * grid.pitch < 1:
+        return grid._replace(skew=0.0)
+    return grid
+
+
+def decode_frames(frames, decoder=None):
+    # yield (frame index, payload) for every new payload in an iterator of PIL images or numpy arrays
+    decoder = decoder or FrameDecoder()
+    for index, frame in enumerate(frames):
+        payload = decoder.decode_frame(frame)
+        if payload is not None:
+            yield index, payload
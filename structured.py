@@ -0,0 +1,159 @@
+import zlib
+
+from batch import chunked, run_pool
+from compression import compress_payload
+from pipeline import build_symbol, decode_from_image, DEFAULT_ARRAY_SIZE, DEFAULT_ECC_LEVEL
+
+# '~', then sequence index, symbol count and crc32 of the whole payload as hex,
+# plain ascii so the header never holds the 0x00 / 0xff bytes the bars cannot carry
+HEADER_MARKER = b'~'
+HEADER_SIZE = 1 + 2 + 2 + 8
+MAX_SYMBOLS = 255
+# bytes a chunk end is moved back at most to find a symbol that reads back whole
+MAX_CHUNK_SHIFT = 16
+
+
+def make_header(index, total, checksum):
+    return HEADER_MARKER + b'%02x%02x%08x' % (index, total, checksum)
+
+
+def parse_header(message):
+    # split a decoded symbol message into (index, total, checksum, chunk)
+    message = bytes(message)
+    if len(message) < HEADER_SIZE or not message.startswith(HEADER_MARKER):
+        raise ValueError("Not a structured append symbol")
+    try:
+        index = int(message[1:3], 16)
+        total = int(message[3:5], 16)
+        checksum = int(message[5:13], 16)
+    except ValueError:
+        raise ValueError("Corrupted structured append header")
+    if index >= total:
+        raise ValueError(f"Symbol index {index} out of range for {total} symbols")
+    return index, total, checksum, message[HEADER_SIZE:]
+
+
+def chunk_capacity(array_size, error_correction_level):
+    # payload bytes per symbol after the structured append header
+    chunk_size = array_size - 4 - error_correction_level - HEADER_SIZE
+    if chunk_size <= 0:
+        raise ValueError(
+            f"Byte array too small ({array_size}) for ECC level {error_correction_level} "
+            f"and a {HEADER_SIZE} byte structured append header."
+        )
+    return chunk_size
+
+
+def check_total(total):
+    if total > MAX_SYMBOLS:
+        raise ValueError(f"Payload needs {total} symbols, at most {MAX_SYMBOLS} are supported.")
+
+
+def split_payload(data, array_size=DEFAULT_ARRAY_SIZE, error_correction_level=DEFAULT_ECC_LEVEL):
+    # cut the payload into header + chunk messages that each fit one symbol
+    chunk_size = chunk_capacity(array_size, error_correction_level)
+    total = max(1, -(-len(data) // chunk_size))
+    check_total(total)
+    checksum = zlib.crc32(data)
+    return [make_header(index, total, checksum) + data[index * chunk_size:(index + 1) * chunk_size]
+            for index in range(total)]
+
+
+def reads_back(symbol, message, array_size, error_correction_level):
+    # whether a clean render of the symbol gives back its whole codeword: the header and the compression keep
+    # 0x00 / 0xff out of the message, not out of the reed-solomon parity, where 0xff draws as a white bar that
+    # reads as 0x00 and 00 00 is where get_data_from_array ends the codeword
+    stored = len(compress_payload(message, array_size - 4 - error_correction_level))
+    data = bytes(symbol[3:-1])
+    end = data.find(b'\x00\x00')
+    return 0xff not in data and (end == -1 or end >= stored + error_correction_level)
+
+
+def encode_chunks(data, total, checksum, array_size, error_correction_level):
+    # symbols for the payload with the given count in their headers; a chunk whose symbol would not read back
+    # gives its last bytes to the next chunk until it does, the reassembler joins chunks of any length.
+    # raw binary chunks can hold 0xff themselves, no boundary helps those and they keep their full size
+    chunk_size = chunk_capacity(array_size, error_correction_level)
+    symbols = []
+    start = 0
+    while start < len(data) or not symbols:
+        check_total(len(symbols) + 1)
+        full = min(chunk_size, len(data) - start)
+        candidates = []
+        # an empty payload still gets one header-only symbol
+        for size in range(full, max(full - MAX_CHUNK_SHIFT + 1, min(full, 1)) - 1, -1):
+            message = make_header(len(symbols), total, checksum) + data[start:start + size]
+            candidates.append((build_symbol(message, array_size, error_correction_level), size))
+            if reads_back(candidates[-1][0], message, array_size, error_correction_level):
+                break
+        else:
+            candidates = candidates[:1]
+        symbol, size = candidates[-1]
+        symbols.append(symbol)
+        start += size
+    return symbols
+
+
+def encode_structured(data, array_size=DEFAULT_ARRAY_SIZE, error_correction_level=DEFAULT_ECC_LEVEL):
+    # one symbol array per chunk, ready for get_array_image; shortened chunks can need more symbols than
+    # split_payload, and the count is in every header, so encode again with the new count until it holds
+    data = bytes(data)
+    checksum = zlib.crc32(data)
+    total = max(1, -(-len(data) // chunk_capacity(array_size, error_correction_level)))
+    while True:
+        check_total(total)
+        symbols = encode_chunks(data, total, checksum, array_size, error_correction_level)
+        if len(symbols) == total:
+            return symbols
+        total = len(symbols)
+
+
+class Reassembler:
+    # collects decoded symbol messages in any order, several payloads may be interleaved
+
+    def __init__(self):
+        self.pending = {}
+
+    def add(self, message):
+        # returns the full payload once its last missing symbol arrives, otherwise None
+        index, total, checksum, chunk = parse_header(message)
+        parts = self.pending.setdefault((total, checksum), {})
+        parts[index] = chunk
+        if len(parts) < total:
+            return None
+        del self.pending[(total, checksum)]
+        data = b''.join(parts[i] for i in range(total))
+        if zlib.crc32(data) != checksum:
+            raise ValueError("Structured append checksum mismatch")
+        return data
+
+    def missing(self):
+        # (total, checksum) -> sorted indexes still missing, for every incomplete payload
+        return {key: sorted(set(range(key[0])) - set(parts)) for key, parts in self.pending.items()}
+
+
+def try_decode(sources):
+    # worker task: decode a chunk of symbol images, None for the ones that do not read
+    messages = []
+    for source in sources:
+        try:
+            messages.append(bytes(decode_from_image(source)))
+        except Exception:
+            messages.append(None)
+    return messages
+
+
+def reassemble(sources, workers=None, chunk_size=4, reassembler=None):
+    # decode symbol images in parallel and yield every payload as soon as its set is complete
+    reassembler = reassembler or Reassembler()
+    for messages in run_pool(try_decode, chunked(sources, chunk_size), workers):
+        for message in messages:
+            if message is None:
+                continue
+            try:
+                data = reassembler.add(message)
+            except ValueError:
+                # not one of ours or a damaged header, wait for a rescan
+                continue
+            if data is not None:
+                yield data
@@ -0,0 +1,162 @@
+import argparse
+import csv
+import itertools
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from barcode_drawer import get_array_image, simulate_image_noise
+from compression import decompress_payload
+from encoder import decode_data, decode_data_with_confidence, ReedSolomonError
+from pipeline import build_symbol
+from utils import read_array_and_confidence, get_data_from_array, compare_results
+
+STAGES = ('encode', 'render', 'noise', 'read', 'decode')
+
+
+def run_trial(array_size, barWidth, barHeight, error_correction_level, noise_level, rng, use_erasures=True):
+    # one encode -> render -> noise -> decode round trip with a random printable payload
+    payload = bytes(rng.integers(32, 127, array_size - 4 - error_correction_level, dtype=np.uint8))
+    timings = {}
+    decoded = b''
+    try:
+        start = time.perf_counter()
+        symbol = build_symbol(payload, array_size, error_correction_level)
+        timings['encode'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        image = get_array_image(symbol, barWidth, barHeight)
+        timings['render'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        image = simulate_image_noise(image, noise_level, seed=rng)
+        timings['noise'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        read_array, confidence = read_array_and_confidence(image)
+        data_chunk, ecc = get_data_from_array(read_array)
+        timings['read'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        if use_erasures:
+            decoded = decompress_payload(decode_data_with_confidence(data_chunk, ecc, confidence[3:3 + len(data_chunk)])[0])
+        else:
+            decoded = decompress_payload(decode_data(data_chunk, ecc))
+        timings['decode'] = time.perf_counter() - start
+    except (ValueError, ReedSolomonError):
+        pass
+    return decoded == payload, compare_results(payload, decoded), timings
+
+
+def run_chunk(cell, seed, cell_index, first_trial, count, use_erasures=True):
+    # trials are seeded by (seed, cell, trial) so results do not depend on how work is split
+    array_size, barWidth, barHeight, error_correction_level, noise_level = cell
+    successes = byte_errors = 0
+    timings = {stage: [] for stage in STAGES}
+    for trial in range(first_trial, first_trial + count):
+        rng = np.random.default_rng([seed, cell_index, trial])
+        success, errors, trial_timings = run_trial(array_size, barWidth, barHeight, error_correction_level, noise_level,
+                                                   rng, use_erasures)
+        successes += success
+        byte_errors += errors
+        for stage, elapsed in trial_timings.items():
+            timings[stage].append(elapsed)
+    return cell_index, successes, byte_errors, timings
+
+
+def summarize(cell, trials, successes, byte_errors, timings):
+    array_size, barWidth, barHeight, error_correction_level, noise_level = cell
+    row = {
+        'array_size': array_size,
+        'bar_width': barWidth,
+        'bar_height': barHeight,
+        'error_correction_level': error_correction_level,
+        'noise_level': noise_level,
+        'trials': trials,
+        'success_rate': successes / trials,
+        'mean_byte_errors': byte_errors / trials,
+    }
+    # latencies in milliseconds, stages after a failure have fewer samples
+    for stage in STAGES:
+        samples = np.array(timings[stage]) * 1000
+        row[f'{stage}_ms_mean'] = float(samples.mean()) if len(samples) else None
+        row[f'{stage}_ms_p95'] = float(np.percentile(samples, 95)) if len(samples) else None
+    return row
+
+
+def sweep(array_sizes, bar_widths, error_correction_levels, noise_levels, trials=1000, barHeight=100,
+          seed=0, workers=None, chunk_size=50, use_erasures=True):
+    cells = [(size, width, barHeight, ecc, noise)
+             for size, width, ecc, noise in itertools.product(array_sizes, bar_widths, error_correction_levels, noise_levels)
+             # at least one payload byte must fit next to the ecc bytes
+             if size - 4 - ecc > 0]
+    totals = [[0, 0, {stage: [] for stage in STAGES}] for _ in cells]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(run_chunk, cell, seed, index, first, min(chunk_size, trials - first), use_erasures)
+                   for index, cell in enumerate(cells)
+                   for first in range(0, trials, chunk_size)]
+        for future in futures:
+            index, successes, byte_errors, timings = future.result()
+            totals[index][0] += successes
+            totals[index][1] += byte_errors
+            for stage in STAGES:
+                totals[index][2][stage].extend(timings[stage])
+    return [summarize(cell, trials, *total) for cell, total in zip(cells, totals)]
+
+
+def write_csv(rows, filename):
+    with open(filename, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=list(rows[0]))
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def write_json(rows, filename):
+    with open(filename, 'w') as f:
+        json.dump(rows, f, indent=2)
+
+
+def parse_list(kind):
+    # comma separated values, e.g. 100,150,200
+    return lambda text: [kind(value) for value in text.split(',') if value]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Monte Carlo decode reliability sweep.")
+    parser.add_argument('--array-sizes', type=parse_list(int), default=[150])
+    parser.add_argument('--bar-widths', type=parse_list(int), default=[20])
+    parser.add_argument('--ecc-levels', type=parse_list(int), default=[20, 40, 80])
+    parser.add_argument('--noise-levels', type=parse_list(float), default=[0.01, 0.05, 0.1])
+    parser.add_argument('--bar-height', type=int, default=100)
+    parser.add_argument('--trials', type=int, default=1000, help="trials per grid cell")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--chunk-size', type=int, default=50, help="trials per worker task")
+    parser.add_argument('--no-erasures', action='store_true', help="decode without marking low confidence bars as erasures")
+    parser.add_argument('--csv', help="write one row per grid cell to this CSV file")
+    parser.add_argument('--json', help="write the results to this JSON file")
+    args = parser.parse_args(argv)
+
+    start = time.perf_counter()
+    rows = sweep(args.array_sizes, args.bar_widths, args.ecc_levels, args.noise_levels, args.trials,
+                 args.bar_height, args.seed, args.workers, args.chunk_size, not args.no_erasures)
+    elapsed = time.perf_counter() - start
+    if not rows:
+        parser.error("no grid cell leaves room for a payload, raise --array-sizes or lower --ecc-levels")
+
+    if args.csv:
+        write_csv(rows, args.csv)
+    if args.json:
+        write_json(rows, args.json)
+    for row in rows:
+        print(f"size {row['array_size']:4d} bar {row['bar_width']:3d} ecc {row['error_correction_level']:3d} "
+              f"noise {row['noise_level']:.3f}: success {row['success_rate']:.3f}, "
+              f"byte errors {row['mean_byte_errors']:.2f}")
+    print(f"{len(rows) * args.trials} trials in {elapsed:.1f} s")
+
+
+if __name__ == "__main__":
+    main()
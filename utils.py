@@ -1,48 +1,114 @@
 import colorsys
+import hashlib
+import os
+import tempfile
+from collections import namedtuple
+from functools import lru_cache
+
+import numpy as np
 from PIL import Image
 
-def format_image(image, expected_width):
-    # try each rotation to find the finder pattern
-    for angle in (0, 90, 180, 270):
-        cand = image.rotate(angle, expand=True)
-        # convert to grayscale for bar detection
-        gray = cand.convert('L', dither=Image.NONE)
-        w, h = gray.size
-        px = gray.load()
-        mid_y = h // 2
-        # find first dark pixel on middle row
-        start = next((x for x in range(w) if px[x, mid_y] < 128), None)
-        if start is None:
-            continue
-        # find where the dark run ends
-        end = next((x for x in range(start+1, w) if px[x, mid_y] >= 128), None)
-        if end is None:
-            continue
-        bar_w = end - start
-        # skip if there is not enough space for finder bars
-        if start + 2*bar_w + bar_w//2 >= w:
-            continue
-        rgb = cand.convert('RGB').load()
-        # sample the three finder bar centers
-        centers = [
-            rgb[start + bar_w//2,        mid_y],
-            rgb[start + bar_w + bar_w//2, mid_y],
-            rgb[start + 2*bar_w + bar_w//2, mid_y],
-        ]
-        def is_black(c): return sum(c)/3 < 64
-        def is_colored(c):
-            h_, s_, v_ = colorsys.rgb_to_hsv(c[0]/255, c[1]/255, c[2]/255)
-            return s_ > 0.5 and v_ > 0.5
-        # confirm pattern black colored black
-        if is_black(centers[0]) and is_colored(centers[1]) and is_black(centers[2]):
-            rotation = angle
-            detected_bar_width = bar_w
-            break
-    else:
-        raise ValueError("Could not detect rotation/finder pattern")
+from barcode_drawer import row_indicator, row_count_code, MAX_STACK_ROWS, ROW_INDICATOR_SPAN, ROW_COUNT_STEP
+from instrument import stage
+
+# number of scanlines combined when reading bars straight from the source image
+SCAN_LINES = 7
+# scanlines per row of a stacked symbol, fewer leave too much gaussian noise in each row's median
+STACK_SCAN_LINES = 5
+# smallest channel jump between neighbouring pixels that counts as a bar edge
+EDGE_THRESHOLD = 64
+# bars darker than this value read as black, brighter and less saturated than these read as white
+BLACK_VALUE = 0.1
+WHITE_VALUE = 0.9
+WHITE_SATURATION = 0.1
+# override where the rgb -> byte table is stored, the default is next to this module
+CLASSIFY_TABLE_ENV = 'QRCODE_CLASSIFY_TABLE'
+# skew search passes as (half width, step) in degrees, each centred on the best angle of the one before
+SKEW_SEARCH = ((45.0, 1.0), (1.0, 0.1), (0.1, 0.01))
+# the skew is measured on a copy whose longest side is at most this many pixels,
+# from at most this many of its strongest edge pixels
+SKEW_MAX_SIDE = 1024
+SKEW_MAX_EDGES = 20000
+# every this many rows and columns are searched for a finder-like run before a skew is measured,
+# runs shorter than FINDER_MIN_RUN pixels are noise
+FINDER_LINE_STEP = 16
+FINDER_MIN_RUN = 4
+# channel spread or darkness that marks a pixel as part of a symbol rather than white paper
+INK_SPREAD = 64
+
+# where the bars of a symbol sit in an image: reading direction, image size it was found in,
+# first bar edge and pitch in pixels along the scanlines, bar count including the logo gap,
+# the tilt in degrees of a skewed symbol, and the (middle, height) of the symbol across the scanlines
+# when it does not fill the image
+BarGrid = namedtuple('BarGrid', 'rotation size start pitch count logo_bars skew band', defaults=(0.0, None))
+
+def is_dark(rgb):
+    # dark means no bright channel, grayscale luma would also count saturated blue and red bars as dark
+    return rgb.max(axis=-1) < 128
+
+
+def orientation_lines(image):
+    # the middle row of the image rotated by each angle, read straight from the original
+    w, h = image.size
+    def row(y): return np.asarray(image.crop((0, y, w, y + 1)))[0]
+    def column(x): return np.asarray(image.crop((x, 0, x + 1, h)))[:, 0]
+    return (
+        (0, row(h // 2)),
+        (90, column(w - 1 - w // 2)),
+        (180, row(h - 1 - h // 2)[::-1]),
+        (270, column(w // 2)[::-1]),
+    )
+
+
+def find_finder_pattern(line):
+    # return (start, bar width) if the line starts with black, colored, black bars
+    dark = is_dark(line)
+    w = len(line)
+    # find first dark pixel on the line
+    if not dark.any():
+        return None
+    start = int(np.argmax(dark))
+    # find where the dark run ends
+    light = ~dark[start + 1:]
+    if not light.any():
+        return None
+    bar_w = int(np.argmax(light)) + 1
+    # skip if there is not enough space for finder bars
+    if start + 2*bar_w + bar_w//2 >= w:
+        return None
+    # sample the three finder bar centers
+    centers = [
+        line[start + bar_w//2],
+        line[start + bar_w + bar_w//2],
+        line[start + 2*bar_w + bar_w//2],
+    ]
+    def is_black(c): return int(c[0]) + int(c[1]) + int(c[2]) < 192
+    def is_colored(c):
+        h_, s_, v_ = colorsys.rgb_to_hsv(c[0]/255, c[1]/255, c[2]/255)
+        return s_ > 0.5 and v_ > 0.5
+    # confirm pattern black colored black
+    if is_black(centers[0]) and is_colored(centers[1]) and is_black(centers[2]):
+        return start, bar_w
+    return None
+
 
-    # rotate image to correct orientation
-    image = image.rotate(rotation, expand=True, resample=Image.Resampling.NEAREST)
+def detect_rotation(image):
+    # test the finder pattern for every orientation on a single row or column each
+    for angle, line in orientation_lines(image):
+        if find_finder_pattern(line) is not None:
+            return angle
+    raise ValueError("Could not detect rotation/finder pattern")
+
+
+@stage('format')
+def format_image(image, expected_width, debug_hook=None):
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    rotation = detect_rotation(image)
+
+    # rotate image to correct orientation, once
+    if rotation:
+        image = image.rotate(rotation, expand=True, resample=Image.Resampling.NEAREST)
     width, height = image.size
     # choose bar width for cropping
 
@@ -53,56 +119,565 @@ def format_image(image, expected_width):
     
 
 
-    # save for inspection
-    image.save('barcode_formatted.png')
+    # hand the aligned image out for inspection, e.g. to save it
+    if debug_hook is not None:
+        debug_hook(image)
     return image
 
 
-def get_array_from_image(image, barWidth, barHeight):
+def rgb_to_hsv_array(rgb):
+    # vectorized colorsys.rgb_to_hsv over the last axis of a float array in [0, 1]
+    r, g, b = rgb[..., 0], rgb[..., 1], rgb[..., 2]
+    maxc = rgb.max(axis=-1)
+    minc = rgb.min(axis=-1)
+    rangec = maxc - minc
+    v = maxc
+    gray = rangec == 0
+    # avoid dividing by zero on gray pixels, their hue and saturation are forced to 0 below
+    safe_max = np.where(maxc == 0, 1.0, maxc)
+    safe_range = np.where(gray, 1.0, rangec)
+    s = np.where(gray, 0.0, rangec / safe_max)
+    rc = (maxc - r) / safe_range
+    gc = (maxc - g) / safe_range
+    bc = (maxc - b) / safe_range
+    # same branch order as colorsys: red max first, then green, then blue
+    h = np.where(r == maxc, bc - gc, np.where(g == maxc, 2.0 + rc - bc, 4.0 + gc - rc))
+    h = np.where(gray, 0.0, np.mod(h / 6.0, 1.0))
+    return h, s, v
+
+
+def is_blank(s_, v_):
+    return (v_ < BLACK_VALUE) | ((v_ > WHITE_VALUE) & (s_ < WHITE_SATURATION))
+
+
+def classify_hsv(rgb_avg):
+    # map averaged bar colors (integers 0-255) to bytes, black and white bars read as 0
+    h_, s_, v_ = rgb_to_hsv_array(rgb_avg / 255.0)
+    return np.where(is_blank(s_, v_), 0, np.round(h_ * 255)).astype(np.uint8)
+
+
+def classify_table_path():
+    # the file name carries the thresholds, so changing them builds a new table instead of reading a stale one
+    key = hashlib.sha1(repr((BLACK_VALUE, WHITE_VALUE, WHITE_SATURATION)).encode()).hexdigest()[:12]
+    default = os.path.join(os.path.dirname(os.path.abspath(__file__)), f'classify_table_{key}.npy')
+    return os.environ.get(CLASSIFY_TABLE_ENV) or default
+
+
+def build_classify_table():
+    # classify_hsv for every rgb triple, one red plane at a time to keep the float temporaries small
+    table = np.empty((256, 256, 256), dtype=np.uint8)
+    gb = np.stack(np.meshgrid(np.arange(256), np.arange(256), indexing='ij'), axis=-1)
+    plane = np.empty((256, 256, 3), dtype=np.int64)
+    plane[..., 1:] = gb
+    for r in range(256):
+        plane[..., 0] = r
+        table[r] = classify_hsv(plane)
+    return table
+
+
+@lru_cache(maxsize=None)
+def classify_table():
+    # rgb -> byte for every integer color, memory-mapped so every worker process shares the same pages
+    path = classify_table_path()
+    try:
+        return np.load(path, mmap_mode='r')
+    except (OSError, ValueError):
+        pass
+    table = build_classify_table()
+    try:
+        # write under a temporary name and rename, workers starting together never read a half written file
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.npy')
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, table)
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, path)
+        return np.load(path, mmap_mode='r')
+    except OSError:
+        # read-only install, keep the table in memory for this process
+        return table
+
+
+def classify_colors(rgb_avg):
+    # map averaged bar colors (integers 0-255) to bytes with one gather from the precomputed table
+    rgb_avg = np.asarray(rgb_avg, dtype=np.intp)
+    return np.asarray(classify_table()[rgb_avg[..., 0], rgb_avg[..., 1], rgb_avg[..., 2]])
+
+
+def bar_confidence(rgb_avg, concentration):
+    # how sure each bar classification is, from 0 (a guess) to 1 (clean bar)
+    h_, s_, v_ = rgb_to_hsv_array(rgb_avg / 255.0)
+    blank = is_blank(s_, v_)
+    # black and white bars: how far past the classification thresholds they are
+    black = np.clip((BLACK_VALUE - v_) / BLACK_VALUE, 0.0, 1.0)
+    white = np.clip(np.minimum((v_ - WHITE_VALUE) / (1 - WHITE_VALUE), (WHITE_SATURATION - s_) / WHITE_SATURATION),
+                    0.0, 1.0)
+    # colored bars: saturation and value, hue spread across the bar and distance to the nearest hue bin
+    bins = h_ * 255
+    bin_confidence = 1 - 2 * np.abs(bins - np.round(bins))
+    colored = np.minimum(s_, v_) * concentration * bin_confidence
+    return np.where(blank, np.maximum(black, white), colored)
+
+
+def hue_vectors(pixels):
+    # per-pixel hue as a unit vector weighted by saturation * value, so gray pixels barely count
+    h_, s_, v_ = rgb_to_hsv_array(pixels / 255.0)
+    weight = s_ * v_
+    angle = 2 * np.pi * h_
+    return np.stack((weight * np.cos(angle), weight * np.sin(angle), weight), axis=-1)
+
+
+def hue_concentration(sums):
+    # length of the summed hue vectors over their total weight: 1 when every pixel has the same hue
+    total = np.where(sums[..., 2] > 0, sums[..., 2], 1.0)
+    return np.hypot(sums[..., 0], sums[..., 1]) / total
+
+
+def average_bar_blocks(image, barWidth):
     # convert image to RGB for sampling
     image = image.convert('RGB')
     w, h = image.size
     n = w // barWidth
-    px = image.load()
-    array = bytearray(n)
-
-    # sample each bar by averaging all pixels in its column block
-    for i in range(n):
-        r_sum = g_sum = b_sum = 0
-        x0 = i * barWidth
-        # iterate every pixel in this bar’s width and full height
-        for dx in range(barWidth):
-            for y in range(h):
-                r, g, b = px[x0 + dx, y]
-                r_sum += r
-                g_sum += g
-                b_sum += b
-        count = barWidth * h
-        r_avg = r_sum // count
-        g_avg = g_sum // count
-        b_avg = b_sum // count
-
-        # convert average color to HSV
-        h_, s_, v_ = colorsys.rgb_to_hsv(r_avg/255.0,
-                                         g_avg/255.0,
-                                         b_avg/255.0)
-        # decide if bar is black or colored
-        if v_ < 0.1 or (v_ > 0.9 and s_ < 0.1):
-            array[i] = 0
-        else:
-            array[i] = int(round(h_ * 255))
+    pixels = np.asarray(image)[:, :n * barWidth]
+
+    # view the image as (height, bars, barWidth, 3) and average each bar block in one pass
+    blocks = pixels.reshape(h, n, barWidth, 3)
+    # reducing the height first keeps the sum on contiguous memory
+    sums = blocks.sum(axis=0, dtype=np.uint32).sum(axis=1, dtype=np.int64)
+    return pixels, sums // (barWidth * h)
 
-    # remove finder and logo gap as before
-    logo_width_in_bars = barHeight // barWidth
-    return array[:3] + array[3 + logo_width_in_bars:]
+
+@stage('sample')
+def get_array_from_image(image, barWidth, barHeight):
+    pixels, rgb_avg = average_bar_blocks(image, barWidth)
+
+    # decide if each bar is black or colored
+    array = bytearray(classify_colors(rgb_avg).tobytes())
 
     # we know 3 bars are finder, and then barHeight/barWidth bars are logo gap
-    # remove logo gap from array
     logo_width_in_bars = barHeight // barWidth
-    array_no_logo = array[:3] + array[3 + logo_width_in_bars:]
-    return array_no_logo
+    if is_stacked(pixels, array, 3 + logo_width_in_bars, barWidth):
+        raise ValueError("Stacked symbol, the block sampler reads one row only; use read_array_from_image.")
+    return array[:3] + array[3 + logo_width_in_bars:]
+
+
+def is_stacked(pixels, array, header, barWidth):
+    # a stacked symbol has a row count in its header bar and row indicators of different hues in the bar after it,
+    # the first two codeword bars of a single row symbol are the same color over the full height
+    rows = read_row_count(array[header]) if len(array) > header + 2 else None
+    if rows is None:
+        return False
+    indicator = pixels[:, (header + 1) * barWidth:(header + 2) * barWidth]
+    quarter = max(1, len(indicator) // (4 * rows))
+    # the top of the first row against the bottom of the last one
+    ends = np.stack((indicator[:quarter].reshape(-1, 3).mean(axis=0), indicator[-quarter:].reshape(-1, 3).mean(axis=0)))
+    codes = classify_colors(ends.astype(np.int64))
+    return abs(int(codes[1]) - int(codes[0])) > ROW_INDICATOR_SPAN // rows // 2
+
+
+def scan_lines(image, rotation, count=SCAN_LINES, skew=0.0, band=None, fractions=None):
+    # rows across the middle half of the symbol, in reading order for the given rotation;
+    # a skewed symbol is sampled along its tilted axis instead, within its band from symbol_band;
+    # fractions puts the rows at those heights instead, 0 at the top of the symbol and 1 at its bottom;
+    # without a band the symbol fills the image, the height of the band or the image comes back with the rows
+    if skew:
+        return skewed_scan_lines(image, rotation, count, skew, band, fractions)
+    w, h = image.size
+    across = h if rotation in (0, 180) else w
+    middle, height = band or (0.0, across)
+    if fractions is not None or band is not None:
+        heights = fractions if fractions is not None else np.linspace(0.25, 0.75, count) if count > 1 else [0.5]
+        # the band middle is an offset from the image middle towards the bottom of the symbol
+        top = (across - height) / 2 + middle
+        positions = np.clip(np.round(top + np.asarray(heights) * height - 0.5).astype(int), 0, across - 1)
+        # the top of a symbol read at 90 or 180 degrees is at the far side of the image
+        if rotation in (90, 180):
+            positions = across - 1 - positions
+    else:
+        # a single scanline goes through the middle
+        positions = np.linspace(across // 4, across - 1 - across // 4, count) if count > 1 else [across // 2]
+        positions = np.round(positions).astype(int)
+    if fractions is not None:
+        # the rows of a stacked symbol are close together, one crop holds them all
+        first, last = positions.min(), positions.max() + 1
+        if rotation in (0, 180):
+            lines = np.asarray(image.crop((0, first, w, last)))[positions - first]
+        else:
+            lines = np.asarray(image.crop((first, 0, last, h)))[:, positions - first].transpose(1, 0, 2)
+        return (lines[:, ::-1] if rotation in (180, 270) else lines), height
+    lines = []
+    for pos in positions:
+        if rotation in (0, 180):
+            line = np.asarray(image.crop((0, pos, w, pos + 1)))[0]
+        else:
+            line = np.asarray(image.crop((pos, 0, pos + 1, h)))[:, 0]
+        lines.append(line[::-1] if rotation in (180, 270) else line)
+    return np.stack(lines), height
+
+
+def skew_axes(size, rotation, skew):
+    # image center, unit vectors along the reading order and across it, and the image extent along each
+    w, h = size
+    theta = np.radians(rotation + skew)
+    u = np.array((np.cos(theta), np.sin(theta)))
+    v = np.array((-u[1], u[0]))
+    center = np.array(((w - 1) / 2, (h - 1) / 2))
+    return center, u, v, int(np.ceil(w * abs(u[0]) + h * abs(u[1]))), int(np.ceil(w * abs(v[0]) + h * abs(v[1])))
+
+
+def ink_points(image):
+    # coordinates of every dark or colored pixel, the white paper around a symbol is left out
+    pixels = np.asarray(image)
+    # channel by channel, a max over the last axis of a whole image is many times slower
+    high = np.maximum(np.maximum(pixels[..., 0], pixels[..., 1]), pixels[..., 2])
+    low = np.minimum(np.minimum(pixels[..., 0], pixels[..., 1]), pixels[..., 2])
+    ink = (high - low > INK_SPREAD) | is_dark(high[..., np.newaxis])
+    ys, xs = np.nonzero(ink)
+    return np.stack((xs, ys), axis=-1).astype(np.float32)
+
+
+def symbol_band(points, size, rotation, skew, along=None):
+    # (middle, height) of the symbol across tilted scanlines, from the projection profile of the ink:
+    # the lines through the symbol hold far more ink than the image around it;
+    # along=(first, last) only counts the ink between those positions on the scanlines
+    center, u, v, length, extent = skew_axes(size, rotation, skew)
+    if along is not None:
+        positions = (points - center) @ u + length / 2
+        points = points[(positions >= along[0]) & (positions < along[1])]
+    if not len(points):
+        return 0.0, extent
+    # rounded half up, rint would send the half-pixel offsets of an axis-aligned symbol to every other line
+    offsets = np.floor((points - center) @ v + extent / 2 + 0.5).astype(np.intp)
+    profile = np.bincount(np.clip(offsets, 0, extent), minlength=extent + 1)
+    # the run above half the peak around the peak, its ends interpolated between lines
+    profile = np.concatenate(([0], profile, [0])).astype(float)
+    peak = int(np.argmax(profile))
+    half = profile[peak] / 2
+    first = peak - int(np.argmax(profile[peak::-1] < half))
+    last = peak + int(np.argmax(profile[peak:] < half))
+    start = first + (half - profile[first]) / (profile[first + 1] - profile[first])
+    end = last - 1 + (profile[last - 1] - half) / (profile[last - 1] - profile[last])
+    # start and end are where the symbol edges cross the lines, padded profile index i is offset i - 1
+    return float((start + end) / 2 - 1 - extent / 2), float(end - start)
+
+
+def finder_band(image, rotation, start, pitch):
+    # symbol_band of an axis-aligned symbol, measured on its finder bars alone: they span the full symbol height,
+    # while white paper around the label or a logo would throw the image height off
+    w, h = image.size
+    length = w if rotation in (0, 180) else h
+    first, last = max(0, int(start)), min(length, int(np.ceil(start + 3 * pitch)))
+    if rotation in (180, 270):
+        first, last = length - last, length - first
+    box = (first, 0, last, h) if rotation in (0, 180) else (0, first, w, last)
+    return symbol_band(ink_points(image.crop(box)) + np.array(box[:2], dtype=np.float32), image.size, rotation, 0.0)
+
+
+def sample_points(pixels, xs, ys):
+    # nearest pixel at every (x, y), white outside the image like the paper around a symbol
+    h, w = pixels.shape[:2]
+    xs, ys = np.rint(xs).astype(np.intp), np.rint(ys).astype(np.intp)
+    inside = (xs >= 0) & (xs < w) & (ys >= 0) & (ys < h)
+    samples = np.full(xs.shape + (3,), 255, dtype=np.uint8)
+    samples[inside] = pixels[ys[inside], xs[inside]]
+    return samples
+
+
+def skewed_scan_lines(image, rotation, count, skew, band=None, fractions=None):
+    # the scanlines of scan_lines along the tilted reading axis, no rotated copy of the image is made
+    center, u, v, length, _ = skew_axes(image.size, rotation, skew)
+    middle, across = band or symbol_band(ink_points(image), image.size, rotation, skew)
+    # same positions as the axis-aligned scanlines, relative to the symbol band whose top is towards -v
+    if fractions is not None:
+        offsets = np.asarray(fractions) - 0.5
+    else:
+        offsets = np.linspace(-0.25, 0.25, count) if count > 1 else np.zeros(1)
+    positions = middle + offsets * across
+    along = np.arange(-length / 2, length / 2)
+    points = center + along[np.newaxis, :, np.newaxis] * u + positions[:, np.newaxis, np.newaxis] * v
+    return sample_points(np.asarray(image), points[..., 0], points[..., 1]), across
+
+
+def edge_points(image):
+    # x, y and squared gradient of the strong edges on a reduced copy
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    scale = max(1, -(-max(image.size) // SKEW_MAX_SIDE))
+    pixels = np.asarray(image.reduce(scale) if scale > 1 else image, dtype=np.float32)
+    gx = pixels[1:-1, 2:] - pixels[1:-1, :-2]
+    gy = pixels[2:, 1:-1] - pixels[:-2, 1:-1]
+    weight = (gx * gx + gy * gy).sum(axis=-1)
+    ys, xs = np.nonzero(weight > 0.05 * weight.max())
+    if len(xs) > SKEW_MAX_EDGES:
+        # bar edges are the sharpest in a label, texture and noise around it fill the rest
+        keep = np.argpartition(weight[ys, xs], -SKEW_MAX_EDGES)[-SKEW_MAX_EDGES:]
+        ys, xs = ys[keep], xs[keep]
+    return xs.astype(np.float32), ys.astype(np.float32), weight[ys, xs]
+
+
+def edge_sharpness(xs, ys, weight, theta):
+    # edge weight projected on both axes of the angle: bar edges and the symbol's long sides
+    # pile up in a few bins when the axes line up with the symbol
+    c, s = np.cos(theta), np.sin(theta)
+    total = 0.0
+    for projection in (xs * c + ys * s, ys * c - xs * s):
+        bins = np.rint(projection).astype(np.int64)
+        hist = np.bincount(bins - bins.min(), weights=weight)
+        total += (hist * hist).sum()
+    return total
+
+
+def run_kinds(lines):
+    # 1 black and 2 colored with the thresholds of find_finder_pattern, 0 anything else,
+    # and a 3 after every line so runs never join across lines
+    high, low = lines.max(axis=-1).astype(np.int16), lines.min(axis=-1).astype(np.int16)
+    kind = np.zeros((lines.shape[0], lines.shape[1] + 1), dtype=np.int8)
+    kind[:, :-1][(2 * high > 255) & (2 * (high - low) > high)] = 2
+    kind[:, :-1][lines.sum(axis=-1, dtype=np.int16) < 192] = 1
+    kind[:, -1] = 3
+    return kind.ravel()
+
+
+def has_finder_run(image):
+    # True when a row or column crosses black, colored, black runs of about the same width anywhere along it,
+    # as lines through the finder bars of a label do at any tilt; a frame without one is not worth a skew search
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    pixels = np.asarray(image)
+    # rows first, the columns are only read when no row crosses the finder
+    for lines in (pixels[::FINDER_LINE_STEP], pixels[:, ::FINDER_LINE_STEP].transpose(1, 0, 2)):
+        kind = run_kinds(lines)
+        starts = np.concatenate(([0], np.flatnonzero(np.diff(kind)) + 1))
+        lengths = np.diff(np.append(starts, len(kind)))
+        kinds = kind[starts]
+        first, middle, last = lengths[:-2], lengths[1:-1], lengths[2:]
+        shortest = np.minimum(np.minimum(first, middle), last)
+        longest = np.maximum(np.maximum(first, middle), last)
+        if np.any((kinds[:-2] == 1) & (kinds[1:-1] == 2) & (kinds[2:] == 1)
+                  & (shortest >= FINDER_MIN_RUN) & (longest <= 2 * shortest)):
+            return True
+    return False
+
+
+@stage('skew')
+def estimate_skew(image):
+    # angle in degrees, in [-45, 45], the symbol's bars are tilted by from the nearest image axis,
+    # clockwise as seen on screen; the rotation search still picks the quarter turn
+    xs, ys, weight = edge_points(image)
+    if not len(xs):
+        return 0.0
+    best = 0.0
+    for half_width, step in SKEW_SEARCH:
+        angles = best + np.arange(-half_width, half_width + step / 2, step)
+        best = angles[int(np.argmax([edge_sharpness(xs, ys, weight, np.radians(a)) for a in angles]))]
+    return float(np.clip(round(best, 3), -45.0, 45.0))
+
+
+def best_grid(edges, candidates):
+    # the candidate pitch whose grid lines up with the most edges, and that grid's origin
+    z = np.exp(2j * np.pi * edges[np.newaxis, :] / candidates[:, np.newaxis]).mean(axis=1)
+    best = int(np.argmax(np.abs(z)))
+    return candidates[best], np.angle(z[best]) / (2 * np.pi) * candidates[best]
+
+
+def fit_bar_grid(edges, pitch):
+    # coarse search on the edges near the start, where a rough pitch still lines up, then a fine search on all edges
+    pitch, origin = best_grid(edges[edges < edges[0] + 60 * pitch], pitch * np.linspace(0.8, 1.2, 41))
+    pitch, origin = best_grid(edges, pitch * np.linspace(0.985, 1.015, 61))
+    # then fit origin and pitch by least squares on the edges close to a grid line
+    k = np.round((edges - origin) / pitch)
+    keep = np.abs(edges - origin - k * pitch) < pitch / 4
+    if np.unique(k[keep]).size >= 2:
+        pitch, origin = np.polyfit(k[keep], edges[keep], 1)
+    return origin, pitch
+
+
+def read_array_from_image(image, debug_hook=None):
+    return read_array_and_confidence(image, debug_hook, with_confidence=False)[0]
+
+
+@stage('read')
+def read_array_and_confidence(image, debug_hook=None, skew=0.0, with_confidence=True):
+    # read bars along a few scanlines of the source image, no resize and no known bar width needed,
+    # along with a confidence per bar
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    grid, lines, line = find_bar_grid(image, debug_hook, skew)
+    return sample_symbol(image, grid, lines, line, with_confidence)
+
+
+def sample_symbol(image, grid, lines, line=None, with_confidence=True):
+    # bytes and confidence of the symbol on a known grid, from its rows when it is a stacked one;
+    # the header bar spans the full height, so the single row sampling reads it too, before the hue spread pass
+    codes, rgb_avg, lo, hi = average_bars(lines, grid, line)
+    header = 3 + grid.logo_bars
+    stacked = sample_stacked_rows(image, grid, codes[header], with_confidence) if grid.count > header + 2 else None
+    if stacked:
+        return stacked
+    return keep_bars(grid, codes, measure_confidence(lines, rgb_avg, lo, hi) if with_confidence else None)
+
+
+def read_row_count(header):
+    # row count of a header byte, None when the byte is not close to any count's code,
+    # it is then most likely the first codeword byte of a single row symbol
+    rows = 2 + round((int(header) - row_count_code(2)) / ROW_COUNT_STEP)
+    if not 2 <= rows <= MAX_STACK_ROWS or abs(int(header) - row_count_code(rows)) > ROW_COUNT_STEP // 4:
+        return None
+    return rows
+
+
+def sample_stacked_rows(image, grid, header, with_confidence=True):
+    # the symbol array and confidence of a stacked symbol with the row count of the header byte, all rows sampled
+    # at once, None unless most row indicators agree: the bar after the header is then not one codeword byte
+    # across the whole height, as in a single row symbol
+    rows = read_row_count(header)
+    if rows is None:
+        return None
+    fractions = (np.arange(rows)[:, np.newaxis] + np.linspace(0.25, 0.75, STACK_SCAN_LINES)) / rows
+    lines, _ = scan_lines(image, grid.rotation, skew=grid.skew, band=grid.band, fractions=fractions.ravel())
+    lines = lines.reshape(rows, STACK_SCAN_LINES, *lines.shape[1:])
+    # after the finder and the logo gap come the header bar and each row's indicator, the end bar closes the rows;
+    # the indicator bars are checked on their own pixels first, most single row symbols stop there
+    data = 3 + grid.logo_bars + 2
+    left = int(grid.start + (data - 1) * grid.pitch)
+    right = int(np.ceil(grid.start + data * grid.pitch))
+    indicator = grid._replace(start=grid.start + (data - 1) * grid.pitch - left, count=1)
+    codes, _ = sample_bars(lines[..., left:right, :], indicator, with_confidence=False)
+    found = np.rint((codes[:, 0].astype(float) - row_indicator(0, rows)) / (ROW_INDICATOR_SPAN // rows))
+    if np.count_nonzero(found == np.arange(rows)) * 2 <= rows:
+        return None
+    codes, confidence = sample_bars(lines, grid, with_confidence=with_confidence)
+    # finder from the first row, then the data bars of every row in order, then the end bar
+    array = bytearray(np.concatenate((codes[0, :3], codes[:, data:-1].ravel(), codes[-1, -1:])).tobytes())
+    if confidence is not None:
+        confidence = np.concatenate((confidence[0, :3], confidence[:, data:-1].ravel(), confidence[-1, -1:]))
+    return array, confidence
+
+
+def find_bar_grid(image, debug_hook=None, skew=0.0):
+    # orientation and bar grid of the symbol, with the scanlines and their median it was found on
+    # test every orientation on the per-pixel median of a few scanlines, which drops isolated noise pixels
+    points = ink_points(image) if skew else None
+    error = ValueError("Could not detect rotation/finder pattern")
+    for rotation in (0, 90, 180, 270):
+        band = symbol_band(points, image.size, rotation, skew) if skew else None
+        try:
+            fit = fit_scan_lines(image, rotation, skew, band)
+            if fit is not None and skew:
+                # the short rows of a stacked symbol can be mostly blank padding and pull the band in,
+                # the finder bars span the full height, so measure it again on them alone
+                start, pitch = fit[2][:2]
+                band = symbol_band(points, image.size, rotation, skew, (start, start + 3 * pitch))
+                fit = fit_scan_lines(image, rotation, skew, band)
+            elif fit is not None:
+                # a label with paper around it is shorter than the image, which sets the logo gap and row heights
+                start, pitch = fit[2][:2]
+                band = finder_band(image, rotation, start, pitch)
+                if abs(band[1] - image.size[rotation in (0, 180)]) < pitch / 2:
+                    band = None
+                else:
+                    fit = fit_scan_lines(image, rotation, skew, band)
+        except ValueError as e:
+            # black, colored, black runs across a symbol or inside a logo, try the other orientations
+            error = e
+            continue
+        if fit is not None:
+            break
+    else:
+        raise error
+    lines, line, (start, pitch, n, logo_bars) = fit
+    if debug_hook is not None:
+        debug_hook(Image.fromarray(lines))
+    return BarGrid(rotation, image.size, float(start), float(pitch), n, logo_bars, skew, band), lines, line
+
+
+def fit_scan_lines(image, rotation, skew=0.0, band=None):
+    # (scanlines, their median, grid fit) of the symbol read at one rotation, None without a finder pattern
+    lines, across = scan_lines(image, rotation, skew=skew, band=band)
+    line = np.median(lines, axis=0).astype(np.uint8)
+    finder = find_finder_pattern(line)
+    if finder is None:
+        return None
+    return lines, line, fit_line_grid(lines, line, finder, across)
+
+
+def fit_line_grid(lines, line, finder, across):
+    # (start, pitch, bar count, logo bars) of the symbol on its scanlines and their median, from its finder pattern
+    start, bar_w = finder
+    dark = np.flatnonzero(is_dark(line))
+    # first guess of the pitch from the two black finder bars, the last dark pixel closes the end bar
+    following = dark[dark > start + bar_w]
+    pitch = (following[0] - start) / 2 if len(following) else bar_w
+    end = dark[-1] + 1
+
+    # edges inside the logo, which spans the symbol height after the three finder bars, are not bar boundaries
+    logo_bars = max(1, round(across / pitch))
+    skip_from = start + 3 * pitch + pitch / 4
+    skip_to = start + max((3 + logo_bars) * pitch, 3 * pitch + across) + pitch / 4
+    # an edge has to be on the median line and on most scanlines: the median line of a stacked symbol mixes
+    # rows, and one noisy pixel there moves it from one row's bar color to another's
+    jumps = np.abs(np.diff(line.astype(np.int16), axis=0)).max(axis=1)
+    votes = np.count_nonzero(np.abs(np.diff(lines.astype(np.int16), axis=1)).max(axis=2) >= EDGE_THRESHOLD, axis=0)
+    edges = np.flatnonzero((jumps >= EDGE_THRESHOLD) & (2 * votes > len(lines))) + 1
+    edges = edges[(edges < skip_from) | (edges > skip_to)]
+    if len(edges) < 2:
+        raise ValueError("Could not find bar edges")
+    origin, pitch = fit_bar_grid(edges, pitch)
+
+    # snap the start to the fitted grid, the end bar then fixes the bar count
+    start = origin + round((start - origin) / pitch) * pitch
+    n = max(4, round((end - start) / pitch))
+    logo_bars = max(1, round(across / pitch))
+    if n <= 3 + logo_bars + 1:
+        raise ValueError("No data bars after the finder pattern")
+    return start, pitch, n, logo_bars
+
+
+def sample_bar_grid(lines, grid, line=None, with_confidence=True):
+    # bytes and confidence of every bar on a known grid, line is the per-pixel median of the scanlines;
+    # without confidence the hue spread pass is skipped and None comes back in its place
+    return keep_bars(grid, *sample_bars(lines, grid, line, with_confidence))
+
+
+def keep_bars(grid, codes, confidence=None):
+    # the symbol array and confidence from every bar on the grid, the logo gap dropped
+    keep = np.r_[0:3, 3 + grid.logo_bars:grid.count]
+    return bytearray(codes[keep].tobytes()), None if confidence is None else confidence[keep]
+
+
+def sample_bars(lines, grid, line=None, with_confidence=True):
+    # classified byte and confidence of every bar on the grid, logo gap included; lines may carry a leading
+    # axis of scanline groups, like the rows of a stacked symbol, and every group is sampled at once
+    codes, rgb_avg, lo, hi = average_bars(lines, grid, line)
+    return codes, measure_confidence(lines, rgb_avg, lo, hi) if with_confidence else None
+
+
+def average_bars(lines, grid, line=None):
+    # classified byte and average color of every bar on the grid, with the [lo, hi) pixel window they come from
+    if line is None:
+        line = lines[..., 0, :, :] if lines.shape[-3] == 1 else np.median(lines, axis=-3).astype(np.uint8)
+    start, pitch, n = grid.start, grid.pitch, grid.count
+
+    # average the middle half of every bar
+    length = line.shape[-2]
+    centers = start + (np.arange(n) + 0.5) * pitch
+    lo = np.clip(np.floor(centers - pitch / 4).astype(int), 0, length - 1)
+    hi = np.clip(np.ceil(centers + pitch / 4).astype(int), lo + 1, length)
+    sums = np.cumsum(line, axis=-2, dtype=np.int64)
+    sums = np.concatenate((np.zeros_like(sums[..., :1, :]), sums), axis=-2)
+    rgb_avg = (sums[..., hi, :] - sums[..., lo, :]) // (hi - lo)[:, np.newaxis]
+    return classify_colors(rgb_avg).astype(np.uint8), rgb_avg, lo, hi
+
+
+def measure_confidence(lines, rgb_avg, lo, hi):
+    # hue spread is measured on the raw scanlines, before the median hides it, and only on the middles
+    # that were averaged: the pixels between them and around the symbol are left out
+    widths = hi - lo
+    firsts = np.concatenate(([0], np.cumsum(widths)[:-1]))
+    middles = np.repeat(lo - firsts, widths) + np.arange(widths.sum())
+    vectors = np.add.reduceat(hue_vectors(lines[..., middles, :]).sum(axis=-3), firsts, axis=-2)
+    return bar_confidence(rgb_avg, hue_concentration(vectors))
 
-def get_data_from_array(array, barWidth):
+def get_data_from_array(array, barWidth=None):
     # read error correction level from second bar
     error_correction_level = array[1]
     # strip finder bars and logo gap and end bar